@@ -19,16 +19,35 @@ __copyright__ = "Copyright (c) 2022 Cisco and/or its affiliates."
 __license__ = "Cisco Sample Code License, Version 1.1"
 
 import requests
+from requests.adapters import HTTPAdapter
 import urllib
-import glob
+import urllib3
 import time
-
-
-from flask import Flask, request, redirect, render_template, session
+import threading
+import random
+import math
+import logging
+import itertools
+import multiprocessing
+import sqlite3
+import queue
+import contextvars
+import hashlib
+import secrets
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from multiprocessing.managers import BaseManager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+from functools import partial
+from contextlib import contextmanager
+
+
+from flask import Flask, request, redirect, render_template, session, jsonify, g, has_request_context
 from boto3 import resource
+from botocore.exceptions import ClientError
+from botocore.config import Config
 from dotenv import load_dotenv
 import os
-from webexteamssdk import WebexTeamsAPI
 import json
 
 
@@ -36,11 +55,12 @@ import json
 ### Global variables ###
 ########################
 
-WEBEX_BASE_URL = "https://webexapis.com/v1"
-
 # load environment variables
 load_dotenv()
 
+# Webex API, can be pointed at a stand-in API such as the one of benchmark.py
+WEBEX_BASE_URL = os.getenv("WEBEX_BASE_URL") or "https://webexapis.com/v1"
+
 # Webex integration credentials
 webex_integration_client_id = os.getenv("webex_integration_client_id")
 webex_integration_client_secret = os.getenv("webex_integration_client_secret")
@@ -52,12 +72,131 @@ AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 REGION_NAME = os.getenv("REGION_NAME")
 BUCKET_NAME = os.getenv("BUCKET_NAME")
+# S3 compatible endpoint to use instead of AWS, such as the stand-in of benchmark.py
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
 
 DOWNLOAD_FOLDER = os.getenv("DOWNLOAD_FOLDER")
 MIGRATE_RECORDINGS = os.getenv("MIGRATE_RECORDINGS")
 
 BULK_NAME_FILTER = os.getenv("BULK_NAME_FILTER")
 
+# Size in bytes of the buffer used to stream recordings to storage. This caps the memory used per transfer,
+# regardless of the length of the recording. S3 requires multipart chunks of at least 5 MB.
+TRANSFER_BUFFER_SIZE = int(os.getenv("TRANSFER_BUFFER_SIZE") or 8 * 1024 * 1024)
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Number of times in a row a download is resumed after its connection dropped or its temporary link expired
+DOWNLOAD_RESUME_ATTEMPTS = int(os.getenv("DOWNLOAD_RESUME_ATTEMPTS") or 3)
+
+# Size in bytes of the parts of the S3 multipart uploads, and number of parts of a recording uploaded at the same
+# time. Every transfer holds up to S3_PARTS_IN_FLIGHT parts in memory
+S3_PART_SIZE = max(int(os.getenv("S3_PART_SIZE")
+                   or TRANSFER_BUFFER_SIZE), S3_MIN_PART_SIZE)
+S3_PARTS_IN_FLIGHT = int(os.getenv("S3_PARTS_IN_FLIGHT") or 1)
+# Upload through the S3 Transfer Acceleration endpoint, which must be enabled on the bucket
+S3_USE_ACCELERATE_ENDPOINT = os.getenv("S3_USE_ACCELERATE_ENDPOINT") or "False"
+
+# Caps of the download bandwidth of the recordings, in megabits per second (0 for no cap): for all transfers
+# together, for all transfers during business hours, and for each bulk migration job. Business hours are in the
+# local time of the server, on business days from 1 (Monday) to 7 (Sunday)
+DOWNLOAD_BANDWIDTH_LIMIT = float(os.getenv("DOWNLOAD_BANDWIDTH_LIMIT") or 0)
+BUSINESS_HOURS_BANDWIDTH_LIMIT = float(
+    os.getenv("BUSINESS_HOURS_BANDWIDTH_LIMIT") or DOWNLOAD_BANDWIDTH_LIMIT)
+JOB_BANDWIDTH_LIMIT = float(os.getenv("JOB_BANDWIDTH_LIMIT") or 0)
+BUSINESS_HOURS = os.getenv("BUSINESS_HOURS") or "08:00-18:00"
+BUSINESS_DAYS = os.getenv("BUSINESS_DAYS") or "1-5"
+
+# Number of bulk migration jobs that run at the same time in the background
+JOB_WORKERS = int(os.getenv("JOB_WORKERS") or 1)
+
+# Seconds between the heartbeats of the worker process running a bulk migration job. A job whose worker missed
+# three heartbeats in a row is resumed by another worker process
+JOB_HEARTBEAT_INTERVAL = int(os.getenv("JOB_HEARTBEAT_INTERVAL") or 30)
+JOB_STALE_AFTER = 3 * JOB_HEARTBEAT_INTERVAL
+
+# Where recordings are transferred: "thread" in the app process, or "process" in a pool of TRANSFER_PROCESSES
+# worker processes, so downloads, hashing and uploads are not limited by the GIL of the app process
+TRANSFER_MODE = os.getenv("TRANSFER_MODE") or "thread"
+TRANSFER_PROCESSES = int(os.getenv("TRANSFER_PROCESSES") or os.cpu_count() or 1)
+
+# Seconds between checks for scheduled migrations that are due
+SCHEDULER_POLL_INTERVAL = int(os.getenv("SCHEDULER_POLL_INTERVAL") or 60)
+
+# Seconds before the watermark of a person from which scheduled migrations list their recordings, to pick up the
+# recordings that were still being processed by Webex when the previous run listed them
+WATERMARK_LOOKBACK = int(os.getenv("WATERMARK_LOOKBACK") or 24 * 60 * 60)
+
+# SQLite database where the app keeps its state, such as the catalog of stored recordings
+STATE_DB = os.getenv("STATE_DB") or "migration_state.db"
+
+# Where the state of each admin session (token, sites, people and recordings listed) is kept: "memory" in the app
+# process, or "sqlite" in STATE_DB, shared by the worker processes of a server such as gunicorn. Sessions expire
+# after SESSION_TTL seconds without a request
+SESSION_STORE = os.getenv("SESSION_STORE") or "memory"
+SESSION_TTL = int(os.getenv("SESSION_TTL") or 8 * 60 * 60)
+
+# Seconds between full listings of the S3 bucket to reconcile the catalog of stored recordings with changes made
+# outside of this app. In between, only keys after the last one seen are listed
+CATALOG_FULL_REFRESH_INTERVAL = int(
+    os.getenv("CATALOG_FULL_REFRESH_INTERVAL") or 24 * 60 * 60)
+
+# Maximum number of recordings transferred at the same time in bulk mode, in total and for a single host
+MIGRATION_CONCURRENCY = int(os.getenv("MIGRATION_CONCURRENCY") or 4)
+MIGRATION_PER_HOST_CONCURRENCY = int(
+    os.getenv("MIGRATION_PER_HOST_CONCURRENCY") or 2)
+
+# Number of users whose recordings are listed at the same time in bulk mode
+ENUMERATION_CONCURRENCY = int(os.getenv("ENUMERATION_CONCURRENCY") or 8)
+
+# The period listed for a user is split into months listed at the same time, LISTING_WINDOW_CONCURRENCY at a time
+# per user. A window with a full page of recordings is split in two again, down to LISTING_MIN_WINDOW seconds
+LISTING_WINDOW_CONCURRENCY = int(os.getenv("LISTING_WINDOW_CONCURRENCY") or 4)
+LISTING_MIN_WINDOW = int(os.getenv("LISTING_MIN_WINDOW") or 60 * 60)
+
+# Maximum number of listed recordings waiting to be transferred in bulk mode. Listing pauses when it is reached
+ENUMERATION_QUEUE_SIZE = int(os.getenv("ENUMERATION_QUEUE_SIZE") or 1000)
+
+# Number of recordings deleted from Webex at the same time once migrated, when MIGRATE_RECORDINGS is on
+DELETION_CONCURRENCY = int(os.getenv("DELETION_CONCURRENCY") or 8)
+
+# Number of recordings per page when listing recordings, the maximum allowed by the Webex API
+WEBEX_PAGE_SIZE = 100
+
+# Number of people per page when listing the people directory, the maximum allowed by the Webex API
+WEBEX_PEOPLE_PAGE_SIZE = 1000
+
+# Maximum number of Webex API requests per second shared by all threads. Set to 0 to disable the limit
+WEBEX_API_RATE_LIMIT = float(os.getenv("WEBEX_API_RATE_LIMIT") or 5)
+
+# Number of keep-alive connections kept open per host by the shared HTTP session. Defaults to the number of
+# concurrent transfers and listing windows, so every worker thread can reuse its own connection
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE")
+                     or MIGRATION_CONCURRENCY + ENUMERATION_CONCURRENCY * LISTING_WINDOW_CONCURRENCY)
+
+# Seconds the people directory and host email lookups are cached, and the maximum number of people cached
+PEOPLE_CACHE_TTL = int(os.getenv("PEOPLE_CACHE_TTL") or 60 * 60)
+PEOPLE_CACHE_SIZE = int(os.getenv("PEOPLE_CACHE_SIZE") or 100000)
+
+# Rows per page of the people and recordings tables of the single-user page, and the most a page request can ask for
+UI_PAGE_SIZE = int(os.getenv("UI_PAGE_SIZE") or 50)
+UI_MAX_PAGE_SIZE = 500
+
+# Number of times a Webex API request is retried after being throttled or failing with a server error, and the
+# base and maximum delay in seconds of the exponential backoff between attempts
+WEBEX_MAX_RETRIES = int(os.getenv("WEBEX_MAX_RETRIES") or 5)
+WEBEX_BACKOFF_BASE = float(os.getenv("WEBEX_BACKOFF_BASE") or 1)
+WEBEX_BACKOFF_MAX = float(os.getenv("WEBEX_BACKOFF_MAX") or 60)
+
+# Seconds before the expiry of the Webex access token at which it is refreshed with the refresh token
+WEBEX_TOKEN_REFRESH_MARGIN = int(
+    os.getenv("WEBEX_TOKEN_REFRESH_MARGIN") or 24 * 60 * 60)
+
+# Print a JSON line for every recording transferred, throttled API request and finished job
+STRUCTURED_LOGS = os.getenv("STRUCTURED_LOGS") or "True"
+
+# Identifies this worker process in the claims on bulk migration jobs, which several worker processes share
+WORKER_ID = f"{os.getpid()}-{secrets.token_hex(4)}"
+
 # Flask app
 app = Flask(__name__)
 
@@ -69,27 +208,526 @@ if (AWS_ACCESS_KEY_ID != ""):
         's3',
         aws_access_key_id=AWS_ACCESS_KEY_ID,
         aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        region_name=REGION_NAME
+        region_name=REGION_NAME,
+        endpoint_url=S3_ENDPOINT_URL,
+        # Enough connections for every part in flight of every transfer
+        config=Config(s3={"addressing_style": "path"} if S3_ENDPOINT_URL else {"use_accelerate_endpoint": S3_USE_ACCELERATE_ENDPOINT == "True"},
+                      max_pool_connections=max(10, MIGRATION_CONCURRENCY * (S3_PARTS_IN_FLIGHT + 1)))
     )
 
-sites = []
-selected_site = ""
-meetings = []
-people = []
-selected_person_id = ""
+# Webex token used by the helper functions when set, instead of the one of the admin session. Background jobs set
+# it to the token stored with the job, of the admin that started it or created its schedule
+current_webex_token = contextvars.ContextVar(
+    "current_webex_token", default=None)
+
+# Download bandwidth limiter of the bulk migration job the current thread works for, if it has a cap
+current_job_bandwidth = contextvars.ContextVar(
+    "current_job_bandwidth", default=None)
 
 
 ########################
 ### Helper Functions ###
 ########################
 
-# Get Webex Access Token
+# Token bucket limiting how many requests per second are sent, shared by all the threads using it.
+# When the server asks us to slow down, every thread pauses for the requested time and the rate is halved,
+# after which it slowly recovers towards the configured rate with every successful request
+
+
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    # Block until a request may be sent, or count units (such as bytes) may be used. Counts larger than the burst
+    # are let through once the bucket is full and paid back before the next acquire
+    def acquire(self, count=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait_time = self.paused_until - now
+                elif self.rate <= 0:
+                    return
+                else:
+                    self.tokens = min(self.capacity, self.tokens +
+                                      (now - self.updated) * self.rate)
+                    self.updated = now
+                    needed = min(count, self.capacity)
+                    if self.tokens >= needed:
+                        self.tokens -= count
+                        return
+                    wait_time = (needed - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    # Pause all requests for delay seconds and halve the rate
+    def throttle(self, delay):
+        with self.lock:
+            self.paused_until = max(
+                self.paused_until, time.monotonic() + delay)
+            if self.rate > 0:
+                self.rate = max(self.rate / 2, 0.1)
+                self.tokens = min(self.tokens, 1)
+
+    # Change the configured rate, such as when business hours start or end
+    def set_rate(self, rate):
+        with self.lock:
+            if rate != self.max_rate:
+                self.max_rate = self.rate = rate
+                self.capacity = max(rate, 1)
+                self.tokens = min(self.tokens, self.capacity)
+
+    # Let the rate grow back towards the configured maximum
+    def recover(self):
+        with self.lock:
+            if 0 < self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate +
+                                self.max_rate * 0.05)
+
+# Thread safe cache whose entries expire after ttl seconds, evicting the least recently used entries when it holds
+# more than max_size of them
+
+
+class TTLCache:
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Return the cached value, or None if it is missing or expired
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if time.monotonic() > expires:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# Counters, gauges and histograms of the app, exposed in the Prometheus text format on /metrics. Metrics are
+# declared with describe() and their labels are passed as keyword arguments when they are updated
+
+
+class Metrics:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def describe(self, name, kind, description, buckets=None):
+        self.metrics[name] = {"kind": kind, "description": description,
+                              "buckets": buckets, "values": {}}
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.metrics[name]["values"]
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.metrics[name]["values"][tuple(sorted(labels.items()))] = value
+
+    # Return the values of a metric as a list of (labels, value) pairs, with the labels as a dict
+    def values(self, name):
+        with self.lock:
+            return [(dict(key), value if not isinstance(value, dict) else dict(value))
+                    for key, value in self.metrics[name]["values"].items()]
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            metric = self.metrics[name]
+            histogram = metric["values"].setdefault(
+                key, {"buckets": [0] * len(metric["buckets"]), "sum": 0.0, "count": 0})
+            for index, bound in enumerate(metric["buckets"]):
+                if value <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    # Observe the time spent in a with block
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, metric in self.metrics.items():
+                lines.append(f"# HELP {name} {metric['description']}")
+                lines.append(f"# TYPE {name} {metric['kind']}")
+                for key, value in metric["values"].items():
+                    if metric["kind"] != "histogram":
+                        lines.append(f"{name}{format_labels(key)} {value}")
+                        continue
+                    for bound, count in zip(metric["buckets"], value["buckets"]):
+                        lines.append(
+                            f"{name}_bucket{format_labels(key + (('le', bound),))} {count}")
+                    lines.append(
+                        f"{name}_bucket{format_labels(key + (('le', '+Inf'),))} {value['count']}")
+                    lines.append(
+                        f"{name}_sum{format_labels(key)} {value['sum']}")
+                    lines.append(
+                        f"{name}_count{format_labels(key)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels) + "}"
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TRANSFER_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 7200)
+
+metrics = Metrics()
+metrics.describe("webex_api_requests_total", "counter",
+                 "Requests sent to the Webex API, by status code (error for connection errors)")
+metrics.describe("webex_api_retries_total", "counter",
+                 "Webex API requests that were retries of a throttled or failed request")
+metrics.describe("webex_api_request_duration_seconds", "histogram",
+                 "Latency of the Webex API requests", LATENCY_BUCKETS)
+metrics.describe("webex_token_refreshes_total", "counter",
+                 "Refreshes of the Webex access tokens, by result")
+metrics.describe("webex_listing_duration_seconds", "histogram",
+                 "Time to list all the recordings of a host", TRANSFER_BUCKETS)
+metrics.describe("recording_download_bytes_total", "counter",
+                 "Bytes of recordings downloaded from Webex")
+metrics.describe("recording_download_seconds_total", "counter",
+                 "Time spent waiting for recording downloads, to compute the download rate")
+metrics.describe("recording_upload_bytes_total", "counter",
+                 "Bytes of recordings written to storage")
+metrics.describe("recording_upload_seconds_total", "counter",
+                 "Time spent writing recordings to storage, to compute the upload rate")
+metrics.describe("storage_request_duration_seconds", "histogram",
+                 "Latency of the requests to the storage, by operation", LATENCY_BUCKETS)
+metrics.describe("recording_transfer_duration_seconds", "histogram",
+                 "End to end time to migrate a recording, from getting its details to verifying it", TRANSFER_BUCKETS)
+metrics.describe("recordings_migrated_total", "counter",
+                 "Recordings migrated, by result")
+metrics.describe("transfers_in_progress", "gauge",
+                 "Recordings being transferred")
+metrics.describe("listing_queue_depth", "gauge",
+                 "Listed recordings waiting for a transfer, per bulk job")
+metrics.describe("jobs_queued", "gauge",
+                 "Bulk migration jobs waiting for a worker")
+
+events_logger = logging.getLogger("webex_migration.events")
+events_logger.setLevel(logging.INFO)
+events_logger.propagate = False
+if STRUCTURED_LOGS == "True":
+    events_logger.addHandler(logging.StreamHandler())
+
+# Log an event as a JSON line, for log pipelines to aggregate
+
+
+def log_event(event, **fields):
+    events_logger.info(json.dumps(
+        {"time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "event": event, **fields}, default=str))
+
+# Per endpoint counters and latencies of the requests sent to the Webex API, recorded in the metrics of the app
+
+
+class ApiMetrics:
+    def record(self, method, endpoint, status_code, latency, retried):
+        metrics.inc("webex_api_requests_total", method=method, endpoint=endpoint,
+                    status="error" if status_code is None else status_code)
+        metrics.observe("webex_api_request_duration_seconds",
+                        latency, method=method, endpoint=endpoint)
+        if retried:
+            metrics.inc("webex_api_retries_total",
+                        method=method, endpoint=endpoint)
+
+    # Summary per endpoint of the requests, retries, throttled requests, server and connection errors and latency
+    def summary(self):
+        endpoints = {}
+        for labels, count in metrics.values("webex_api_requests_total"):
+            endpoint = endpoints.setdefault(f"{labels['method']} {labels['endpoint']}", {
+                "requests": 0, "retries": 0, "throttled": 0, "server_errors": 0, "connection_errors": 0})
+            endpoint["requests"] += count
+            if labels["status"] == "error":
+                endpoint["connection_errors"] += count
+            elif labels["status"] == 429:
+                endpoint["throttled"] += count
+            elif labels["status"] >= 500:
+                endpoint["server_errors"] += count
+        for labels, count in metrics.values("webex_api_retries_total"):
+            endpoints[f"{labels['method']} {labels['endpoint']}"]["retries"] = count
+        for labels, histogram in metrics.values("webex_api_request_duration_seconds"):
+            endpoint = endpoints[f"{labels['method']} {labels['endpoint']}"]
+            endpoint["latency_total"] = histogram["sum"]
+            endpoint["latency_avg"] = histogram["sum"] / histogram["count"]
+        return endpoints
+
+
+# HTTP session shared by all Webex API calls and recording downloads, so connections (and their TLS handshakes)
+# are reused instead of being opened for every request
+http_session = requests.Session()
+http_adapter = HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE, pool_block=True)
+http_session.mount("https://", http_adapter)
+http_session.mount("http://", http_adapter)
+
+# Caches of the people directory (per name filter) and of the emails and display name per person ID
+people_cache = TTLCache(PEOPLE_CACHE_TTL, 16)
+person_cache = TTLCache(PEOPLE_CACHE_TTL, PEOPLE_CACHE_SIZE)
+
+webex_rate_limiter = RateLimiter(WEBEX_API_RATE_LIMIT)
+# Shared by all downloads, in bytes per second
+download_bandwidth_limiter = RateLimiter(0)
+# Rate last set on download_bandwidth_limiter by this process
+download_bandwidth_rate = None
+webex_api_metrics = ApiMetrics()
+
+# Manager process holding the rate limiters in process mode, shared by the app process and the transfer worker
+# processes through proxies, so the rate limit and bandwidth caps hold for all the processes together
+
+
+class LimiterManager(BaseManager):
+    pass
+
+
+LimiterManager.register("RateLimiter", RateLimiter)
+
+# Start the limiter manager on first use, and move the Webex API and download bandwidth limiters into it
+
+
+def get_limiter_manager():
+    global limiter_manager, webex_rate_limiter, download_bandwidth_limiter, download_bandwidth_rate
+    with limiter_manager_lock:
+        if limiter_manager is None:
+            manager = LimiterManager(
+                ctx=multiprocessing.get_context("spawn"))
+            manager.start()
+            webex_rate_limiter = manager.RateLimiter(WEBEX_API_RATE_LIMIT)
+            download_bandwidth_limiter = manager.RateLimiter(0)
+            download_bandwidth_rate = None
+            limiter_manager = manager
+        return limiter_manager
+
+
+limiter_manager = None
+limiter_manager_lock = threading.Lock()
+
+# New rate limiter, held by the limiter manager in process mode so the transfer worker processes share it. It is
+# freed once nothing refers to it anymore
+
+
+def new_rate_limiter(rate):
+    if TRANSFER_MODE == "process":
+        return get_limiter_manager().RateLimiter(rate)
+    return RateLimiter(rate)
+
+# Send a request to the Webex API through the shared rate limiter. Requests that are throttled (429) are retried
+# after the time in the Retry-After header, and server errors (5xx) and connection errors are retried with
+# exponential backoff and jitter. The endpoint is the URL template used to group the metrics
+
+
+def webex_api_request(method, url, endpoint, **kwargs):
+    token = get_webex_token()
+    access_token = token.get() if token else None
+    response = send_webex_api_request(
+        method, url, endpoint, access_token, **kwargs)
+    # An access token that expired or was revoked before its expiry is refreshed, and the request sent again
+    if response.status_code == 401 and token and token.refresh(access_token):
+        response = send_webex_api_request(
+            method, url, endpoint, token.get(), **kwargs)
+    return response
 
+# Send a request to the Webex API with the given access token (none for the token exchanges), retrying throttled
+# and failed requests
+
+
+def send_webex_api_request(method, url, endpoint, access_token, headers=None, **kwargs):
+    headers = dict(headers or {})
+    if access_token is not None:
+        headers["Authorization"] = f"Bearer {access_token}"
+    metrics_key = f"{method} {endpoint}"
+    for attempt in range(WEBEX_MAX_RETRIES + 1):
+        webex_rate_limiter.acquire()
+        started = time.monotonic()
+        try:
+            response = http_session.request(
+                method, url, headers=headers, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            webex_api_metrics.record(
+                method, endpoint, None, time.monotonic() - started, attempt > 0)
+            if attempt == WEBEX_MAX_RETRIES:
+                raise
+            time.sleep(backoff_delay(attempt))
+            continue
+        webex_api_metrics.record(
+            method, endpoint, response.status_code, time.monotonic() - started, attempt > 0)
+        if response.status_code == 429:
+            retry_after = response.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.isdigit() else backoff_delay(attempt)
+            print(f'Rate limited by Webex on {metrics_key}, retrying in {delay} seconds')
+            log_event("webex_api_throttled", endpoint=metrics_key,
+                      retry_after=delay, attempt=attempt)
+            webex_rate_limiter.throttle(delay)
+        elif response.status_code >= 500:
+            delay = backoff_delay(attempt)
+            print(
+                f'Webex returned {response.status_code} on {metrics_key}, retrying in {delay:.1f} seconds')
+            log_event("webex_api_server_error", endpoint=metrics_key,
+                      status=response.status_code, attempt=attempt)
+        else:
+            webex_rate_limiter.recover()
+            return response
+        if attempt == WEBEX_MAX_RETRIES:
+            return response
+        if response.status_code != 429:
+            # Throttled requests wait in the rate limiter, together with all the other threads
+            time.sleep(delay)
+
+# Exponential backoff with full jitter for the given retry attempt
+
+
+def backoff_delay(attempt):
+    return random.uniform(0, min(WEBEX_BACKOFF_MAX, WEBEX_BACKOFF_BASE * 2 ** attempt))
+
+# Webex OAuth token that refreshes itself with its refresh token: ahead of its expiry, when it expires in less
+# than WEBEX_TOKEN_REFRESH_MARGIN seconds, and when the Webex API rejects it. data is the dict returned by
+# get_webex_access_token(), which is updated in place, so the session state holding it keeps the new token.
+# on_refresh is called with the data after every refresh, for tokens kept outside of a session
+
+
+class WebexToken:
+    # Seconds before refreshing again ahead of the expiry after a refresh failed
+    RETRY_INTERVAL = 60
+
+    def __init__(self, data, on_refresh=None):
+        self.data = data
+        self.on_refresh = on_refresh
+        self.lock = threading.Lock()
+        self.next_refresh = 0
+
+    # Get the access token, refreshing it first if it is about to expire
+    def get(self):
+        expires_at = self.data.get("expires_at")
+        now = time.time()
+        if expires_at and now > expires_at - WEBEX_TOKEN_REFRESH_MARGIN and now > self.next_refresh:
+            self.refresh(self.data["access_token"])
+        return self.data["access_token"]
+
+    # Refresh the token, unless it was already refreshed since the rejected access token was used and has not
+    # expired since. Returns whether there is a new access token
+    def refresh(self, rejected):
+        with self.lock:
+            if self.data["access_token"] != rejected and time.time() < self.data.get("expires_at", math.inf):
+                return True
+            if not self.data.get("refresh_token"):
+                return False
+            try:
+                self.data.update(refresh_webex_access_token(
+                    self.data["refresh_token"]))
+            except Exception:
+                self.next_refresh = time.time() + self.RETRY_INTERVAL
+                metrics.inc("webex_token_refreshes_total", result="failed")
+                app.logger.exception(
+                    "Failed refreshing the Webex access token, log in again if it keeps failing")
+                return False
+            if self.on_refresh:
+                self.on_refresh(dict(self.data))
+        print("Refreshed the Webex access token")
+        metrics.inc("webex_token_refreshes_total", result="refreshed")
+        log_event("webex_token_refreshed", expires_at=self.data.get("expires_at"))
+        return True
+
+# Get the Webex token of the current job, or of the admin of the current request
+
+
+def get_webex_token():
+    token = current_webex_token.get()
+    if token is not None:
+        return token
+    if has_request_context():
+        if "webex_token" not in g:
+            data = get_session_state()["token"]
+            # The token is refreshed in place in the session state
+            g.webex_token = WebexToken(
+                data, lambda data: mark_session_state_changed()) if data else None
+        return g.webex_token
+    return None
+
+# Get the Webex access token of the current job or admin, refreshed if it was about to expire
+
+
+def get_access_token():
+    token = get_webex_token()
+    return token.get() if token else None
+
+# Get the Webex token data from a response of the access_token endpoint, with the expiry times of its access
+# and refresh tokens
+
+
+def webex_token_data(response):
+    response.raise_for_status()
+    token = response.json()
+    now = time.time()
+    data = {"access_token": token["access_token"]}
+    if token.get("expires_in"):
+        data["expires_at"] = now + token["expires_in"]
+    if token.get("refresh_token"):
+        data["refresh_token"] = token["refresh_token"]
+    if token.get("refresh_token_expires_in"):
+        data["refresh_token_expires_at"] = now + \
+            token["refresh_token_expires_in"]
+    return data
 
-def get_webex_access_token(webex_code):
-    headers_token = {
-        "Content-type": "application/x-www-form-urlencoded"
+# Exchange an authorization code or a refresh token for a token, through the rate limiter and with the retries of
+# the other Webex API requests
+
+
+def exchange_webex_token(body):
+    return webex_token_data(send_webex_api_request("POST", WEBEX_BASE_URL + "/access_token", "access_token", None,
+                                                   headers={"Content-type": "application/x-www-form-urlencoded"},
+                                                   data=body))
+
+# Get a new access token with the refresh token
+
+
+def refresh_webex_access_token(refresh_token):
+    body = {
+        'grant_type': 'refresh_token',
+        'client_id': webex_integration_client_id,
+        'client_secret': webex_integration_client_secret,
+        'refresh_token': refresh_token
     }
+    return exchange_webex_token(body)
+
+# Get Webex Access Token, with its refresh token and their expiry times
+
+
+def get_webex_access_token(webex_code):
     body = {
         'client_id': webex_integration_client_id,
         'code': webex_code,
@@ -97,11 +735,7 @@ def get_webex_access_token(webex_code):
         'grant_type': 'authorization_code',
         'client_secret': webex_integration_client_secret
     }
-    get_token = requests.post(
-        WEBEX_BASE_URL + "/access_token?", headers=headers_token, data=body)
-
-    webex_access_token = get_token.json()['access_token']
-    return webex_access_token
+    return exchange_webex_token(body)
 
 # Get all the sites
 
@@ -109,11 +743,8 @@ def get_webex_access_token(webex_code):
 def get_sites():
     # Get site URLs
     url = f"{WEBEX_BASE_URL}/meetingPreferences/sites"
-    headers = {
-        "Authorization": f"Bearer {webex_access_token}"
-    }
 
-    response = requests.get(url, headers=headers)
+    response = webex_api_request("GET", url, "meetingPreferences/sites")
     response.raise_for_status()
     sites = response.json()['sites']
     return sites
@@ -122,24 +753,126 @@ def get_sites():
 
 
 def get_meetings(from_date, to_date, selected_site, host_email):
-    # Get recordings
-    url = f"{WEBEX_BASE_URL}/recordings?max=100&from={from_date}T00%3A00%3A00&to={to_date}T23%3A59%3A59&siteUrl={selected_site}&hostEmail={host_email}"
-    meetings = []
+    with metrics.timer("webex_listing_duration_seconds"):
+        meetings = [meeting for page in iter_meeting_pages(
+            from_date, to_date, selected_site, host_email) for meeting in page]
+    # Windows are listed in parallel, so put the recordings back in the order of the API, latest first
+    meetings.sort(key=lambda meeting: meeting.get(
+        "timeRecorded", ""), reverse=True)
+    return meetings
+
+# Dates cover whole days, full timestamps (such as a timeRecorded) are used as they are
+
+
+def full_timestamp(date, end=False):
+    if 'T' in date:
+        return date
+    return f"{date}T23:59:59" if end else f"{date}T00:00:00"
+
+
+def parse_timestamp(timestamp):
+    return datetime.strptime(timestamp[:19], "%Y-%m-%dT%H:%M:%S")
+
+
+def format_timestamp(moment):
+    return moment.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+# Split a period into calendar months, as (from, to) timestamps that include both ends
+
+
+def month_windows(from_date, to_date):
+    start, end = full_timestamp(from_date), full_timestamp(to_date, True)
+    windows = []
+    moment = parse_timestamp(start)
     while True:
-        headers = {
-            "Authorization": f"Bearer {webex_access_token}"
-        }
-        time.sleep(1)
-        response = requests.get(url, headers=headers)
-        if (response.status_code == 401):
-            print('Unauthorized!')
-            return []
-        elif (response.status_code == 502 or response.status_code == 503):
-            print('Services unavailable, skipping!')
-            return []
-        else:
-            response.raise_for_status()
-        meetings += response.json()['items']
+        next_month = (moment.replace(day=1, hour=0, minute=0, second=0) +
+                      timedelta(days=32)).replace(day=1)
+        if next_month > parse_timestamp(end):
+            windows.append((start, end))
+            return windows
+        windows.append((start, format_timestamp(
+            next_month - timedelta(seconds=1))))
+        start, moment = format_timestamp(next_month), next_month
+
+
+# Split a window into parts of the same length, none shorter than LISTING_MIN_WINDOW
+
+
+def split_window(window, parts):
+    start, end = parse_timestamp(window[0]), parse_timestamp(window[1])
+    parts = max(min(parts, int((end - start).total_seconds() // LISTING_MIN_WINDOW)), 1)
+    step = (end - start) / parts
+    boundaries = [(start + step * part).replace(microsecond=0)
+                  for part in range(1, parts)]
+    starts = [window[0]] + [format_timestamp(boundary + timedelta(seconds=1))
+                            for boundary in boundaries]
+    ends = [format_timestamp(boundary)
+            for boundary in boundaries] + [window[1]]
+    return list(zip(starts, ends))
+
+# List the recordings of a host in a window. If the first page is full and the window can still be split, the
+# window is too dense to page through quickly: only that page is returned, with the parts of the window to list
+# instead, sized after the time covered by the first page so each part holds about a page. The API returns the
+# latest recordings first, so when the page is in that order the parts only cover the time before the page.
+# Otherwise all the pages of the window are returned
+
+
+def list_meeting_window(window, selected_site, host_email):
+    pages = iter_meeting_window_pages(
+        window[0], window[1], selected_site, host_email)
+    meetings = next(pages, [])
+    window_seconds = (parse_timestamp(
+        window[1]) - parse_timestamp(window[0])).total_seconds()
+    if len(meetings) >= WEBEX_PAGE_SIZE and window_seconds > LISTING_MIN_WINDOW:
+        pages.close()
+        times = [parse_timestamp(meeting["timeRecorded"])
+                 for meeting in meetings]
+        page_seconds = max((max(times) - min(times)).total_seconds(), 1)
+        if times == sorted(times, reverse=True):
+            # The oldest recording of the page is listed again, recordings are deduplicated
+            window = (window[0], format_timestamp(times[-1]))
+            window_seconds = (times[-1] - parse_timestamp(
+                window[0])).total_seconds()
+        parts = math.ceil(window_seconds / page_seconds * 1.25)
+        return meetings, split_window(window, max(min(parts, 64), 2))
+    for page in pages:
+        meetings += page
+    return meetings, []
+
+# Generator over the pages of recordings of a host, fetched as they are consumed so a caller can start working on
+# the first recordings while the others are not listed yet. The period is split into monthly windows listed in
+# parallel, and dense windows are split again, so hosts with thousands of recordings are not listed one page at a
+# time. Windows include both ends and a split window is listed again, so recordings are deduplicated by ID
+
+
+def iter_meeting_pages(from_date, to_date, selected_site, host_email):
+    seen = set()
+    windows = month_windows(from_date, to_date)
+    while windows:
+        dense_windows = []
+        for meetings, halves in run_concurrently(windows, partial(list_meeting_window, selected_site=selected_site,
+                                                                  host_email=host_email),
+                                                 lambda window: window, LISTING_WINDOW_CONCURRENCY, 1):
+            dense_windows += halves
+            page = [meeting for meeting in meetings if meeting["id"] not in seen]
+            seen.update(meeting["id"] for meeting in page)
+            if page:
+                yield page
+        windows = dense_windows
+
+# Generator over the pages of recordings of a host in a single window, following the 'next' links of the API
+
+
+def iter_meeting_window_pages(from_date, to_date, selected_site, host_email):
+    from_date = urllib.parse.quote(full_timestamp(from_date))
+    to_date = urllib.parse.quote(full_timestamp(to_date, True))
+    url = f"{WEBEX_BASE_URL}/recordings?max={WEBEX_PAGE_SIZE}&from={from_date}&to={to_date}&siteUrl={selected_site}&hostEmail={host_email}"
+    while True:
+        response = webex_api_request("GET", url, "recordings")
+        # Server errors that persist after retrying, and tokens that could not be refreshed, are raised so the user
+        # is reported instead of skipped
+        response.raise_for_status()
+        yield response.json()['items']
         if not response.headers.get('link', None):
             break
         elif response.headers["link"].split(';')[1].strip() == 'rel="next"':
@@ -148,34 +881,507 @@ def get_meetings(from_date, to_date, selected_site, host_email):
         else:
             break
 
-    return meetings
+# Extract the recording ID from the name of a stored recording. Format of the name: 'topic---id.mp4'
+
+
+def recording_id_from_key(key):
+    return os.path.basename(key)[:-len('.mp4')].rsplit('---', 1)[1]
+
+# Persistent catalog of the IDs of the recordings stored in the AWS S3 bucket or local folder, kept in SQLite so
+# checking whether a recording is stored does not depend on the size of the bucket. Recordings copied by this app
+# are added as soon as they are stored. The bucket itself is only listed incrementally (keys after the last one
+# seen) and fully reconciled every CATALOG_FULL_REFRESH_INTERVAL seconds to pick up changes made elsewhere. The
+# local folder is only scanned again when its modification time changes
+
+
+class RecordingsCatalog:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS stored_recordings (id TEXT PRIMARY KEY, key TEXT NOT NULL)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS catalog_state (name TEXT PRIMARY KEY, value TEXT)")
+
+    def __contains__(self, recording_id):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM stored_recordings WHERE id = ?", (recording_id,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM stored_recordings").fetchone()[0]
+
+    def get_state(self, name):
+        row = self.db.execute(
+            "SELECT value FROM catalog_state WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, name, value):
+        self.db.execute(
+            "INSERT OR REPLACE INTO catalog_state (name, value) VALUES (?, ?)", (name, value))
+
+    # Add a stored recording, returns False if the name is not in the expected format
+    def add(self, key, replace=True):
+        try:
+            recording_id = recording_id_from_key(key)
+        except IndexError:
+            return False
+        with self.lock, self.db:
+            self.db.execute(f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO stored_recordings (id, key) VALUES (?, ?)",
+                            (recording_id, key))
+        return True
+
+    # Bring the catalog up to date with the configured storage
+    def refresh(self):
+        sink = get_storage_sink()
+        if sink is None:
+            return
+        destination = sink.destination
+        with self.lock, self.db:
+            if self.get_state("destination") != destination:
+                # The storage changed since the catalog was built, start over
+                self.db.execute("DELETE FROM stored_recordings")
+                self.db.execute("DELETE FROM catalog_state")
+                self.set_state("destination", destination)
+        if (AWS_ACCESS_KEY_ID != ""):
+            self.refresh_bucket()
+        else:
+            self.refresh_folder()
+
+    def refresh_bucket(self):
+        with self.lock:
+            last_full_refresh = float(self.get_state(
+                "last_full_refresh") or 0)
+            last_key = self.get_state("last_key")
+        full_refresh = time.time() - last_full_refresh > CATALOG_FULL_REFRESH_INTERVAL
+        list_arguments = {"Bucket": BUCKET_NAME}
+        if not full_refresh and last_key:
+            list_arguments["StartAfter"] = last_key
+        started = time.time()
+        seen = []
+        for page in s3.meta.client.get_paginator('list_objects_v2').paginate(**list_arguments):
+            for bucket_obj in page.get('Contents', []):
+                last_key = bucket_obj['Key'] if last_key is None else max(
+                    last_key, bucket_obj['Key'])
+                if not bucket_obj['Key'].endswith('.mp4'):
+                    continue
+                if self.add(bucket_obj['Key'], replace=full_refresh):
+                    seen.append(bucket_obj['Key'])
+                else:
+                    app.logger.info(
+                        f"Found a recording in AWS in the wrong format: {bucket_obj['Key']}")
+        with self.lock, self.db:
+            if full_refresh:
+                # Forget recordings that are no longer in the bucket
+                self.db.execute(
+                    "CREATE TEMP TABLE IF NOT EXISTS seen_keys (key TEXT PRIMARY KEY)")
+                self.db.execute("DELETE FROM seen_keys")
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO seen_keys (key) VALUES (?)", ((key,) for key in seen))
+                self.db.execute(
+                    "DELETE FROM stored_recordings WHERE key NOT IN (SELECT key FROM seen_keys)")
+                self.set_state("last_full_refresh", str(started))
+            if last_key:
+                self.set_state("last_key", last_key)
+
+    def refresh_folder(self):
+        folder = os.path.dirname(DOWNLOAD_FOLDER) or '.'
+        folder_mtime = str(os.stat(folder).st_mtime_ns)
+        with self.lock:
+            if self.get_state("folder_mtime") == folder_mtime:
+                return
+        files = [entry.path for entry in os.scandir(
+            folder) if entry.path.startswith(DOWNLOAD_FOLDER) and entry.name.endswith('.mp4')]
+        rows = []
+        for file in files:
+            try:
+                rows.append((recording_id_from_key(file), file))
+            except IndexError:
+                app.logger.info(
+                    f"Found a recording in local storage in the wrong format: {file}")
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM stored_recordings")
+            self.db.executemany(
+                "INSERT OR REPLACE INTO stored_recordings (id, key) VALUES (?, ?)", rows)
+            self.set_state("folder_mtime", folder_mtime)
+
+
+stored_recordings_catalog = RecordingsCatalog(STATE_DB)
+
+# States of a recording in a bulk migration job. An uploaded recording is complete in storage but not verified yet,
+# so it is still unfinished: it is verified when the job resumes
+ITEM_LISTED = "listed"
+ITEM_DOWNLOADING = "downloading"
+ITEM_UPLOADED = "uploaded"
+ITEM_VERIFIED = "verified"
+ITEM_DELETED = "deleted"
+ITEM_FAILED = "failed"
+ITEM_DONE_STATES = (ITEM_VERIFIED, ITEM_DELETED)
+
+# States of a bulk migration job. Jobs that are running (or were when the app stopped) or ended with failures
+# are resumed when the same migration is started again
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_INCOMPLETE = "incomplete"
+
+# Persistent journal of the bulk migration jobs, kept in SQLite next to the catalog. It records which people
+# have been listed and the state of every recording found, so an interrupted job only lists the people and
+# transfers the recordings it had not finished yet. The ID of unfinished S3 multipart uploads is kept too, so
+# they continue after their last completed part. Jobs and schedules belong to the admin that created them, whose
+# Webex token they are stored with, so they run with it even when nobody is logged in. A job is claimed by the
+# worker process that runs it (its owner) and kept alive with a heartbeat, so worker processes sharing the journal
+# never run the same job at the same time
+
+
+class MigrationJournal:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS migration_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, site TEXT NOT NULL, from_date TEXT NOT NULL,
+                to_date TEXT NOT NULL, status TEXT NOT NULL, created REAL NOT NULL, updated REAL NOT NULL)""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS job_people (
+                job_id INTEGER NOT NULL, person_id TEXT NOT NULL, listed INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (job_id, person_id))""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS job_items (
+                job_id INTEGER NOT NULL, recording_id TEXT NOT NULL, host_email TEXT NOT NULL,
+                meeting TEXT NOT NULL, state TEXT NOT NULL, filename TEXT, upload_id TEXT, result TEXT,
+                updated REAL NOT NULL, PRIMARY KEY (job_id, recording_id))""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS schedules (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, site TEXT NOT NULL, person_ids TEXT NOT NULL,
+                frequency TEXT NOT NULL, start_date TEXT NOT NULL, next_run REAL NOT NULL, created REAL NOT NULL)""")
+            # End of the latest scheduled listing per site and host whose recordings were all migrated, where the
+            # next scheduled listing starts
+            self.db.execute("""CREATE TABLE IF NOT EXISTS watermarks (
+                site TEXT NOT NULL, host_email TEXT NOT NULL, time_recorded TEXT NOT NULL,
+                PRIMARY KEY (site, host_email))""")
+            # Columns added after the first version of the journal
+            self.add_missing_column(
+                "migration_jobs", "schedule_id", "INTEGER")
+            self.add_missing_column("job_people", "host_email", "TEXT")
+            self.add_missing_column("migration_jobs", "admin_id", "TEXT")
+            self.add_missing_column("migration_jobs", "token", "TEXT")
+            self.add_missing_column("schedules", "admin_id", "TEXT")
+            self.add_missing_column("schedules", "token", "TEXT")
+            self.add_missing_column("migration_jobs", "owner", "TEXT")
+            self.add_missing_column("migration_jobs", "heartbeat", "REAL")
+
+    def add_missing_column(self, table, column, column_type):
+        columns = [row[1] for row in self.db.execute(
+            f"PRAGMA table_info({table})")]
+        if column not in columns:
+            self.db.execute(
+                f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+    def create_job(self, site, from_date, to_date, schedule_id=None, admin_id=None, token=None):
+        with self.lock, self.db:
+            now = time.time()
+            return self.db.execute("INSERT INTO migration_jobs (site, from_date, to_date, status, created, updated, schedule_id, admin_id, token) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   (site, from_date, to_date, JOB_QUEUED, now, now, schedule_id, admin_id, json.dumps(token) if token else None)).lastrowid
+
+    # Return the ID of the latest job of the admin for the same site and period that did not complete, or None
+    def find_resumable_job(self, site, from_date, to_date, admin_id):
+        with self.lock:
+            row = self.db.execute("SELECT id FROM migration_jobs WHERE site = ? AND from_date = ? AND to_date = ? AND status != ? AND schedule_id IS NULL AND admin_id = ? ORDER BY id DESC LIMIT 1",
+                                  (site, from_date, to_date, JOB_COMPLETED, admin_id)).fetchone()
+        return row[0] if row else None
+
+    # Return the IDs of the jobs that are queued or running, but whose worker stopped (no heartbeat since
+    # stale_before), and can run with their token
+    def interrupted_jobs(self, stale_before):
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT id FROM migration_jobs WHERE status IN (?, ?) AND token IS NOT NULL AND COALESCE(heartbeat, updated) < ? ORDER BY id",
+                                                      (JOB_QUEUED, JOB_RUNNING, stale_before))]
+
+    # Claim a job for the worker, unless it completed or another worker owns it and had a heartbeat since
+    # stale_before. Returns whether the worker owns the job
+    def claim_job(self, job_id, owner, stale_before):
+        with self.lock, self.db:
+            return self.db.execute("UPDATE migration_jobs SET owner = ?, heartbeat = ? WHERE id = ? AND status != ? AND (owner IS NULL OR owner = ? OR heartbeat < ?)",
+                                   (owner, time.time(), job_id, JOB_COMPLETED, owner, stale_before)).rowcount == 1
+
+    def heartbeat(self, owner):
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE migration_jobs SET heartbeat = ? WHERE owner = ?", (time.time(), owner))
+
+    # Set the final status of a job and release it, so any worker can resume it
+    def finish_job(self, job_id, status):
+        with self.lock, self.db:
+            self.db.execute("UPDATE migration_jobs SET status = ?, owner = NULL, updated = ? WHERE id = ?",
+                            (status, time.time(), job_id))
+
+    def recent_jobs(self, admin_id, limit=20):
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT id FROM migration_jobs WHERE admin_id = ? ORDER BY id DESC LIMIT ?",
+                                                      (admin_id, limit))]
+
+    # Webex token data the job runs with, or None for jobs created before tokens were stored with them
+    def get_job_token(self, job_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT token FROM migration_jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def set_job_token(self, job_id, token):
+        with self.lock, self.db:
+            self.db.execute("UPDATE migration_jobs SET token = ? WHERE id = ?",
+                            (json.dumps(token), job_id))
+
+    # Return the number of recordings of the job in each state
+    def item_counts(self, job_id):
+        with self.lock:
+            return dict(self.db.execute("SELECT state, COUNT(*) FROM job_items WHERE job_id = ? GROUP BY state",
+                                        (job_id,)).fetchall())
+
+    def get_job(self, job_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id, site, from_date, to_date, status, schedule_id, admin_id FROM migration_jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(zip(("id", "site", "from_date", "to_date", "status", "schedule_id", "admin_id"), row)) if row else None
+
+    def set_job_status(self, job_id, status):
+        with self.lock, self.db:
+            self.db.execute("UPDATE migration_jobs SET status = ?, updated = ? WHERE id = ?",
+                            (status, time.time(), job_id))
+
+    # Register the people of the job and return the IDs of those whose recordings have not been listed yet
+    def people_to_list(self, job_id, person_ids):
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR IGNORE INTO job_people (job_id, person_id) VALUES (?, ?)",
+                                ((job_id, person_id) for person_id in person_ids))
+            return {row[0] for row in self.db.execute("SELECT person_id FROM job_people WHERE job_id = ? AND listed = 0",
+                                                      (job_id,))}
+
+    # Add a page of recordings listed for a person. Returns the recordings that were not in the journal of the job
+    # yet, so recordings listed again when a job is resumed are not transferred twice
+    def add_listed_recordings(self, job_id, recordings):
+        added = []
+        with self.lock, self.db:
+            now = time.time()
+            for recording in recordings:
+                if self.db.execute("INSERT OR IGNORE INTO job_items (job_id, recording_id, host_email, meeting, state, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                                   (job_id, recording["id"], recording["host_email"], json.dumps(recording), ITEM_LISTED, now)).rowcount:
+                    added.append(recording)
+        return added
+
+    # Mark a person as listed once all the pages of their recordings are in the journal
+    def set_person_listed(self, job_id, person_id, host_email):
+        with self.lock, self.db:
+            self.db.execute("UPDATE job_people SET listed = 1, host_email = ? WHERE job_id = ? AND person_id = ?",
+                            (host_email, job_id, person_id))
+
+    # Return the recordings of the job that have not been transferred, with their journal state
+    def unfinished_items(self, job_id):
+        with self.lock:
+            rows = self.db.execute(f"SELECT meeting, state, filename, upload_id FROM job_items WHERE job_id = ? AND state NOT IN ({', '.join('?' * len(ITEM_DONE_STATES))})",
+                                   (job_id, *ITEM_DONE_STATES)).fetchall()
+        return [dict(json.loads(meeting), job_id=job_id, state=state, filename=filename, upload_id=upload_id)
+                for meeting, state, filename, upload_id in rows]
+
+    def verified_items(self, job_id):
+        with self.lock:
+            rows = self.db.execute("SELECT recording_id, host_email, result FROM job_items WHERE job_id = ? AND state = ?",
+                                   (job_id, ITEM_VERIFIED)).fetchall()
+        return [dict(json.loads(result), id=recording_id, host_email=host_email)
+                for recording_id, host_email, result in rows]
+
+    def update_item(self, job_id, recording_id, **fields):
+        fields["updated"] = time.time()
+        with self.lock, self.db:
+            self.db.execute(f"UPDATE job_items SET {', '.join(f'{name} = ?' for name in fields)} WHERE job_id = ? AND recording_id = ?",
+                            (*fields.values(), job_id, recording_id))
+
+    def add_schedule(self, site, person_ids, frequency, start_date, next_run, admin_id, token):
+        with self.lock, self.db:
+            return self.db.execute("INSERT INTO schedules (site, person_ids, frequency, start_date, next_run, created, admin_id, token) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                   (site, json.dumps(person_ids), frequency, start_date, next_run, time.time(), admin_id, json.dumps(token))).lastrowid
+
+    # Delete a schedule of the admin. Returns whether the admin had such a schedule
+    def delete_schedule(self, schedule_id, admin_id):
+        with self.lock, self.db:
+            return self.db.execute(
+                "DELETE FROM schedules WHERE id = ? AND admin_id = ?", (schedule_id, admin_id)).rowcount == 1
+
+    # Move the next run of a schedule from the one that is due. Returns False when another worker moved it first,
+    # which then runs the schedule
+    def claim_schedule_run(self, schedule_id, due_run, next_run):
+        with self.lock, self.db:
+            return self.db.execute("UPDATE schedules SET next_run = ? WHERE id = ? AND next_run = ?",
+                                   (next_run, schedule_id, due_run)).rowcount == 1
+
+    # Return the schedules of the admin, or of every admin when admin_id is None
+    def get_schedules(self, admin_id=None):
+        with self.lock:
+            rows = self.db.execute("SELECT id, site, person_ids, frequency, start_date, next_run, admin_id FROM schedules WHERE ? IS NULL OR admin_id = ? ORDER BY id",
+                                   (admin_id, admin_id)).fetchall()
+        return [dict(zip(("id", "site", "person_ids", "frequency", "start_date", "next_run", "admin_id"), row[:2] + (json.loads(row[2]),) + row[3:]))
+                for row in rows]
+
+    def get_schedule(self, schedule_id):
+        return next((schedule for schedule in self.get_schedules() if schedule["id"] == schedule_id), None)
+
+    # Webex token data the jobs of the schedule start with, or None for schedules created before tokens were stored
+    def get_schedule_token(self, schedule_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT token FROM schedules WHERE id = ?", (schedule_id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def set_schedule_token(self, schedule_id, token):
+        with self.lock, self.db:
+            self.db.execute("UPDATE schedules SET token = ? WHERE id = ?",
+                            (json.dumps(token), schedule_id))
+
+    # Return whether a job of the schedule is still queued or running
+    def schedule_has_active_job(self, schedule_id):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM migration_jobs WHERE schedule_id = ? AND status IN (?, ?)",
+                                   (schedule_id, JOB_QUEUED, JOB_RUNNING)).fetchone() is not None
+
+    def get_watermark(self, site, host_email):
+        with self.lock:
+            row = self.db.execute("SELECT time_recorded FROM watermarks WHERE site = ? AND host_email = ?",
+                                  (site, host_email)).fetchone()
+        return row[0] if row else None
+
+    # Move the watermark of every person of the job who was listed and whose recordings were all migrated, including
+    # people without any recording, to the end of the period listed by the job, so the next scheduled run only lists
+    # recordings from there on
+    def advance_watermarks(self, job_id, site, to_date):
+        with self.lock, self.db:
+            rows = self.db.execute(f"""SELECT host_email FROM job_people
+                WHERE job_id = ? AND listed = 1 AND host_email IS NOT NULL AND host_email NOT IN (
+                    SELECT host_email FROM job_items WHERE job_id = ? AND state NOT IN ({', '.join('?' * len(ITEM_DONE_STATES))}))""",
+                                   (job_id, job_id, *ITEM_DONE_STATES)).fetchall()
+            self.db.executemany("""INSERT INTO watermarks (site, host_email, time_recorded) VALUES (?, ?, ?)
+                ON CONFLICT (site, host_email) DO UPDATE SET time_recorded = MAX(time_recorded, excluded.time_recorded)""",
+                                ((site, host_email, to_date) for host_email, in rows))
+
+    # Return the summary entries of the recordings of the job that were migrated and that failed
+    def summary(self, job_id):
+        with self.lock:
+            rows = self.db.execute("SELECT state, result FROM job_items WHERE job_id = ? AND result IS NOT NULL ORDER BY updated",
+                                   (job_id,)).fetchall()
+        migrated = [json.loads(result)
+                    for state, result in rows if state in ITEM_DONE_STATES]
+        failed = [json.loads(result)
+                  for state, result in rows if state == ITEM_FAILED]
+        return migrated, failed
+
+
+migration_journal = MigrationJournal(STATE_DB)
+
+# Session stores keep the state of each admin session by session ID, as a dict that is saved back after every
+# request. Expired sessions are dropped when they are read and when a session is saved
+
+# Session store in the memory of the app process, for a server running the app in a single process
+
+
+class MemorySessionStore:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, session_id):
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            if entry is None or entry[0] < time.time():
+                return None
+            return json.loads(entry[1])
+
+    def set(self, session_id, state):
+        now = time.time()
+        with self.lock:
+            self.sessions = {key: entry for key, entry in self.sessions.items()
+                             if entry[0] >= now}
+            self.sessions[session_id] = (now + self.ttl, json.dumps(state))
+
+    def delete(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+# Session store in the SQLite database, shared by all the processes of the app on the same host
+
+
+class SQLiteSessionStore:
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY, state TEXT NOT NULL, expires REAL NOT NULL)""")
+
+    def get(self, session_id):
+        with self.lock:
+            row = self.db.execute("SELECT state FROM sessions WHERE id = ? AND expires >= ?",
+                                  (session_id, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, session_id, state):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute(
+                "DELETE FROM sessions WHERE expires < ?", (now,))
+            self.db.execute("INSERT OR REPLACE INTO sessions (id, state, expires) VALUES (?, ?, ?)",
+                            (session_id, json.dumps(state), now + self.ttl))
+
+    def delete(self, session_id):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+
+if SESSION_STORE == "sqlite":
+    session_store = SQLiteSessionStore(STATE_DB, SESSION_TTL)
+else:
+    session_store = MemorySessionStore(SESSION_TTL)
+
+# Get the state of the admin session of the current request, starting a new session if it has none or it
+# expired. The Flask session cookie only holds the session ID, the state is kept in session_store
+
+
+def get_session_state():
+    if "session_state" not in g:
+        state = session_store.get(
+            session["sid"]) if "sid" in session else None
+        if state is None:
+            session["sid"] = secrets.token_urlsafe(32)
+            state = {"token": None, "admin_id": None, "sites": [], "selected_site": "", "meetings": [],
+                     "selected_person_id": ""}
+            mark_session_state_changed()
+        g.session_state = state
+    return g.session_state
+
+# Mark the state of the admin session as changed by the current request, so it is saved once the request is handled
+
+
+def mark_session_state_changed():
+    g.session_state_changed = True
+
+# Save the state of the admin session once the request is handled, if the request changed it. Requests that only
+# read it, such as the progress polls of the bulk page and the pages of the tables, do not write it back
+
+
+@app.after_request
+def save_session_state(response):
+    if g.get("session_state_changed"):
+        session_store.set(session["sid"], g.session_state)
+    return response
 
-# Function to return recordings stored in the AWS S3 bucket or local folder
+# Function to return the catalog of recordings stored in the AWS S3 bucket or local folder, brought up to date.
+# Use the 'in' operator to check whether a recording ID is stored
 
 
 def get_stored_recordings():
-    stored_recordings = []
-    if (AWS_ACCESS_KEY_ID != ""):
-        for bucket_obj in s3.Bucket(BUCKET_NAME).objects.all():
-            # Format of stored_recordings name: 'topic---id.mp4'
-            # Extract ID from title of recording
-            try:
-                stored_recordings.append(
-                    (bucket_obj.key.split('.')[0]).split('---')[1])
-            except:
-                app.logger.info(
-                    f"Found a recording in AWS in the wrong format: {bucket_obj.key}")
-    elif (DOWNLOAD_FOLDER != ""):
-        for file in glob.glob(DOWNLOAD_FOLDER+"*.mp4"):
-            # Format of stored_recordings name: 'topic---id.mp4'
-            # Extract ID from filename of recording
-            try:
-                stored_recordings.append(
-                    (file.split('.')[0]).split('---')[1])
-            except:
-                app.logger.info(
-                    f"Found a recording in local storage in the wrong format: {file}")
-    return stored_recordings
+    stored_recordings_catalog.refresh()
+    return stored_recordings_catalog
 
 # Function to check whether a meetings has been migrated to AWS already or not
 
@@ -189,58 +1395,1325 @@ def are_meetings_in_storage(meetings, stored_recordings):
             meeting["inStorage"] = False
     return meetings
 
-# Get all the people in your organization
+# Read a download stream in parts of at most part_size bytes, so only one part is held in memory at a time
 
 
-def get_people(webex_access_token):
-    # Get people
+def read_parts(stream, part_size):
+    while True:
+        part = bytearray()
+        while len(part) < part_size:
+            chunk = stream.read(part_size - len(part))
+            if not chunk:
+                break
+            part += chunk
+        if not part:
+            return
+        yield bytes(part)
+        if len(part) < part_size:
+            return
+
+# Storage sinks. A sink stores the recordings in one kind of storage; every transfer opens a writer on the sink
+# with open(key, resume, upload_id, on_upload_started), which receives the parts of the single download stream in
+# order with write(part) and is then either committed, aborted (discarding what was written) or closed (keeping it
+# so the transfer can be resumed). Writers expose offset, the number of bytes already stored by an interrupted
+# transfer being resumed, part_size, the size of the parts they expect, and key, the name of the stored recording,
+# and read_existing() returns the bytes already stored in chunks, or None if they cannot be read back. Sinks also
+# return the size of a stored recording with stat(), delete() it, keep its size and checksum in a sidecar file next
+# to it with write_sidecar() and read it back with read_sidecar(), compute the checksum of the stored recording with
+# checksum() when that is cheap (None otherwise) and give the key it is cataloged under with key(). New storage
+# targets only need a sink and a writer class, returned by get_storage_sink()
+
+
+class S3Sink:
+    def __init__(self, bucket_name):
+        self.bucket_name = bucket_name
+        self.destination = f"s3://{bucket_name}"
+
+    # Start the upload of a recording. When resuming, the multipart upload upload_id is continued after its
+    # completed parts if it still exists. on_upload_started is called with the ID of a new multipart upload
+    def open(self, key, resume=False, upload_id=None, on_upload_started=None):
+        writer = S3Writer(self, key, on_upload_started)
+        if resume and upload_id is not None:
+            completed = self.get_completed_parts(key, upload_id)
+            if completed is not None:
+                writer.upload_id = upload_id
+                writer.parts, writer.offset = completed
+                print(
+                    f"Resuming upload of {key} after {len(writer.parts)} parts ({writer.offset} bytes)")
+        return writer
+
+    def key(self, filename):
+        return filename
+
+    # Return the size of a stored recording with a HEAD request, or None if it is not stored
+    def stat(self, key):
+        try:
+            return s3.meta.client.head_object(Bucket=self.bucket_name, Key=key)['ContentLength']
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    # Delete a stored recording and its sidecar
+    def delete(self, key):
+        s3.meta.client.delete_object(Bucket=self.bucket_name, Key=key)
+        s3.meta.client.delete_object(
+            Bucket=self.bucket_name, Key=key + '.json')
+
+    def write_sidecar(self, key, info):
+        s3.meta.client.put_object(Bucket=self.bucket_name, Key=key + '.json', Body=json.dumps(info).encode(),
+                                  ContentType='application/json')
+
+    def read_sidecar(self, key):
+        try:
+            return json.loads(s3.meta.client.get_object(Bucket=self.bucket_name, Key=key + '.json')['Body'].read())
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    # Reading the recording back would cost as much as downloading it again, its sidecar is trusted instead
+    def checksum(self, key):
+        return None
+
+    # Find the parts of an unfinished multipart upload that were completed, so it can be resumed after them.
+    # Returns the completed parts and the number of bytes they hold, or None if the upload no longer exists
+    def get_completed_parts(self, key, upload_id):
+        client = s3.meta.client
+        parts = []
+        try:
+            for page in client.get_paginator('list_parts').paginate(Bucket=self.bucket_name, Key=key, UploadId=upload_id):
+                parts += page.get('Parts', [])
+        except client.exceptions.NoSuchUpload:
+            return None
+        # Only the parts up to the first missing one can be kept, the upload continues right after them
+        completed = []
+        offset = 0
+        for part in sorted(parts, key=lambda part: part['PartNumber']):
+            if part['PartNumber'] != len(completed) + 1:
+                break
+            completed.append(
+                {"ETag": part["ETag"], "PartNumber": part["PartNumber"]})
+            offset += part['Size']
+        return completed, offset
+
+# Writes a recording to an S3 multipart upload. Up to S3_PARTS_IN_FLIGHT parts are uploaded at the same time,
+# write() blocks while that many are in flight
+
+
+class S3Writer:
+    def __init__(self, sink, key, on_upload_started=None):
+        self.sink = sink
+        self.key = key
+        self.on_upload_started = on_upload_started
+        self.upload_id = None
+        self.parts = []
+        self.offset = 0
+        self.part_size = S3_PART_SIZE
+        self.client = s3.meta.client
+        self.in_flight = set()
+        self.executor = ThreadPoolExecutor(
+            max_workers=S3_PARTS_IN_FLIGHT) if S3_PARTS_IN_FLIGHT > 1 else None
+
+    def write(self, part):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.sink.bucket_name, Key=self.key)['UploadId']
+            if self.on_upload_started:
+                self.on_upload_started(self.upload_id)
+        part_number = len(self.parts) + len(self.in_flight) + 1
+        if self.executor is None:
+            self.parts.append(self.upload_part(part_number, part))
+            return
+        if len(self.in_flight) >= S3_PARTS_IN_FLIGHT:
+            self.wait_for_parts(FIRST_COMPLETED)
+        self.in_flight.add(self.executor.submit(
+            self.upload_part, part_number, part))
+
+    def upload_part(self, part_number, part):
+        with metrics.timer("storage_request_duration_seconds", operation="upload_part"):
+            response = self.client.upload_part(
+                Bucket=self.sink.bucket_name, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=part)
+        return {"ETag": response["ETag"], "PartNumber": part_number}
+
+    # Wait for the parts in flight, raising the error of a part that failed
+    def wait_for_parts(self, return_when=ALL_COMPLETED):
+        done, self.in_flight = wait(self.in_flight, return_when=return_when)
+        for future in done:
+            self.parts.append(future.result())
+
+    def finish_parts(self):
+        if self.executor is not None:
+            try:
+                self.wait_for_parts()
+            finally:
+                self.executor.shutdown()
+
+    def commit(self):
+        self.finish_parts()
+        self.parts.sort(key=lambda part: part["PartNumber"])
+        if self.upload_id is None:
+            # Multipart uploads need at least one part, so empty recordings are stored directly
+            with metrics.timer("storage_request_duration_seconds", operation="put_object"):
+                self.client.put_object(
+                    Bucket=self.sink.bucket_name, Key=self.key, Body=b'')
+        else:
+            with metrics.timer("storage_request_duration_seconds", operation="complete_multipart_upload"):
+                self.client.complete_multipart_upload(
+                    Bucket=self.sink.bucket_name, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": self.parts})
+
+    def abort(self):
+        try:
+            self.finish_parts()
+        except Exception:
+            pass
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.sink.bucket_name, Key=self.key, UploadId=self.upload_id)
+
+    # The parts uploaded so far stay in S3 until the upload is resumed or aborted. Parts in flight are finished
+    # first, so they can be kept when resuming
+    def close(self):
+        try:
+            self.finish_parts()
+        except Exception:
+            pass
+
+    # Parts already uploaded cannot be read back from an unfinished multipart upload
+    def read_existing(self):
+        return None
+
+
+class LocalFolderSink:
+    def __init__(self, folder):
+        self.folder = folder
+        self.destination = f"file://{folder}"
+
+    # Start writing a recording to the folder. A '.part' file left by an interrupted transfer is continued when
+    # resuming, uploads IDs only apply to S3
+    def open(self, filename, resume=False, upload_id=None, on_upload_started=None):
+        return LocalFolderWriter(self.folder + filename, resume)
+
+    def key(self, filename):
+        return self.folder + filename
+
+    def stat(self, filename):
+        try:
+            return os.path.getsize(self.folder + filename)
+        except FileNotFoundError:
+            return None
+
+    # Delete a stored recording and its sidecar
+    def delete(self, filename):
+        os.remove(self.folder + filename)
+        if os.path.exists(self.folder + filename + '.json'):
+            os.remove(self.folder + filename + '.json')
+
+    def write_sidecar(self, filename, info):
+        with open(self.folder + filename + '.json', 'w') as sidecar:
+            json.dump(info, sidecar)
+
+    def read_sidecar(self, filename):
+        try:
+            with open(self.folder + filename + '.json') as sidecar:
+                return json.load(sidecar)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def checksum(self, filename):
+        digest = hashlib.sha256()
+        with open(self.folder + filename, 'rb') as stored:
+            for part in read_parts(stored, TRANSFER_BUFFER_SIZE):
+                digest.update(part)
+        return digest.hexdigest()
+
+# Writes a recording to a temporary '.part' file first, so an interrupted download is never mistaken for a
+# stored recording, and renames it once complete
+
+
+class LocalFolderWriter:
+    def __init__(self, save_as, resume=False):
+        self.key = save_as
+        self.partial = save_as + '.part'
+        self.offset = os.path.getsize(self.partial) if resume and os.path.exists(
+            self.partial) else 0
+        if self.offset:
+            print(f"Resuming download of {save_as} after {self.offset} bytes")
+        self.part_size = TRANSFER_BUFFER_SIZE
+        self.file = open(self.partial, 'r+b' if self.offset else 'wb')
+        self.file.truncate(self.offset)
+        self.file.seek(self.offset)
+
+    def write(self, part):
+        self.file.write(part)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.partial, self.key)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.partial):
+            os.remove(self.partial)
+
+    def close(self):
+        self.file.close()
+
+    def read_existing(self):
+        self.file.flush()
+        with open(self.partial, 'rb') as existing:
+            yield from read_parts(existing, self.part_size)
+
+# Return the sink of the configured storage: the AWS S3 bucket if AWS credentials are set, else the local folder
+
+
+def get_storage_sink():
+    if (AWS_ACCESS_KEY_ID != ""):
+        return S3Sink(BUCKET_NAME)
+    elif (DOWNLOAD_FOLDER != ""):
+        return LocalFolderSink(DOWNLOAD_FOLDER)
+    return None
+
+# Open a download, starting offset bytes into the file. If the server does not honor the Range header, the
+# bytes before the offset are read and dropped instead
+
+
+def open_download(downloadlink, offset=0):
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    response = http_session.get(downloadlink, headers=headers, stream=True)
+    if not response.ok:
+        # The body of the error is not read, so its connection cannot go back to the pool
+        response.close()
+        response.raise_for_status()
+    response.raw.decode_content = True
+    if offset and response.status_code != 206:
+        remaining = offset
+        while remaining > 0:
+            chunk = response.raw.read(min(remaining, TRANSFER_BUFFER_SIZE))
+            if not chunk:
+                response.close()
+                raise IOError(
+                    f"Download ended before the {offset} bytes already transferred")
+            remaining -= len(chunk)
+    return response
 
-    api = WebexTeamsAPI(access_token=webex_access_token)
-    people = []
-    if BULK_NAME_FILTER != '' and len(BULK_NAME_FILTER) >= 3:
-        peopleiterable = api.people.list(displayName=BULK_NAME_FILTER)
+# Download stream that outlives its temporary download link. When the connection drops, the download resumes from
+# the last byte received with a Range request. When the link is rejected as expired (403 or 410), whether before
+# the first byte or when resuming, a fresh link is requested with refresh_link() and the download resumes with it
+
+
+class ResumableDownload:
+    EXPIRED_STATUS_CODES = (403, 410)
+
+    def __init__(self, downloadlink, offset=0, refresh_link=None):
+        self.downloadlink = downloadlink
+        self.offset = offset
+        self.refresh_link = refresh_link
+        self.response = None
+        self.open()
+
+    def open(self):
+        try:
+            self.response = open_download(self.downloadlink, self.offset)
+        except requests.HTTPError as error:
+            if error.response.status_code not in self.EXPIRED_STATUS_CODES or not self.refresh_link:
+                raise
+            print(
+                f"Download link expired at byte {self.offset}, requesting a new one")
+            log_event("download_link_refreshed", offset=self.offset,
+                      status_code=error.response.status_code)
+            self.downloadlink = self.refresh_link()
+            self.response = open_download(self.downloadlink, self.offset)
+
+    def read(self, size=-1):
+        attempts = 0
+        while True:
+            try:
+                if self.response is None:
+                    self.open()
+                data = self.response.raw.read(size)
+                self.offset += len(data)
+                return data
+            except (urllib3.exceptions.HTTPError, requests.ConnectionError, requests.Timeout) as error:
+                self.close()
+                attempts += 1
+                if attempts > DOWNLOAD_RESUME_ATTEMPTS:
+                    raise
+                app.logger.warning(
+                    f"Download interrupted at byte {self.offset}, resuming: {error}")
+                log_event("download_resumed", offset=self.offset,
+                          attempt=attempts, error=str(error))
+
+    # A download read to its end gives its connection back to the pool of the shared session, so the next download
+    # or API request reuses it without a new TLS handshake. A download stopped before its end still has bytes on
+    # the way, so its connection is closed instead
+    def close(self):
+        if self.response is not None:
+            if self.response.raw.closed:
+                self.response.raw.release_conn()
+            else:
+                self.response.close()
+            self.response = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Stream wrapper calling on_progress with the number of bytes of every read
+
+
+class ProgressStream:
+    def __init__(self, stream, on_progress):
+        self.stream = stream
+        self.on_progress = on_progress
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.on_progress(len(data))
+        return data
+
+# Whether it is business hours, when the download bandwidth is capped by BUSINESS_HOURS_BANDWIDTH_LIMIT
+
+
+def in_business_hours(now=None):
+    now = now or datetime.now()
+    first_day, last_day = (int(day) for day in BUSINESS_DAYS.split('-'))
+    start, end = BUSINESS_HOURS.split('-')
+    return first_day <= now.isoweekday() <= last_day and start <= now.strftime("%H:%M") < end
+
+# Stream wrapper capping the download bandwidth with the shared limiter and the limiter of the current job, if
+# any. Reads are split in small chunks so the bandwidth stays smooth whatever the part size
+
+
+class ThrottledStream:
+    CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.job_limiter = current_job_bandwidth.get()
+
+    def read(self, size=-1):
+        global download_bandwidth_rate
+        limit = BUSINESS_HOURS_BANDWIDTH_LIMIT if in_business_hours() else DOWNLOAD_BANDWIDTH_LIMIT
+        # Only set when it changes, the limiter may be in the limiter manager process
+        if limit * 1000 * 1000 / 8 != download_bandwidth_rate:
+            download_bandwidth_rate = limit * 1000 * 1000 / 8
+            download_bandwidth_limiter.set_rate(download_bandwidth_rate)
+        if not limit and not self.job_limiter:
+            return self.stream.read(size)
+        if size < 0 or size > self.CHUNK_SIZE:
+            size = self.CHUNK_SIZE
+        data = self.stream.read(size)
+        download_bandwidth_limiter.acquire(len(data))
+        if self.job_limiter:
+            self.job_limiter.acquire(len(data))
+        return data
+
+# Raised when a stored recording does not have the expected size, or could not be stored
+
+
+class TransferVerificationError(Exception):
+    pass
+
+# Download a recording and stream it to the configured storage without holding the whole file in memory. The
+# recording is downloaded exactly once and its parts are handed to the storage sink as they arrive, while its
+# size and SHA-256 checksum are computed. With resumable set, an interrupted transfer is kept instead of aborted:
+# pass the upload_id reported through on_upload_started (AWS) or just the same filename (local folder) to continue
+# it from where it stopped. on_progress is called with the number of bytes downloaded as the transfer goes, and
+# on_uploaded with the key of the recording once it is complete in storage, before it is verified.
+#
+# The transfer is verified: the bytes received must match expected_size (the sizeBytes of the recording) when it
+# is known, and the stored object must have the size that was streamed, otherwise TransferVerificationError is
+# raised and nothing is kept. The size and checksum are stored in a '.json' sidecar next to the recording. A
+# recording is not downloaded again when it is already stored with the expected size and a sidecar of that size,
+# and in the local folder, when the checksum of the stored file also matches the one of the sidecar. Returns the
+# size, the checksum (None when it cannot be computed, such as for resumed S3 uploads) and whether it was skipped,
+# and only returns once the recording is stored and verified: every failure raises. TransferVerificationError is
+# raised too when no storage is configured.
+#
+# refresh_link returns a fresh download link, used when downloadlink expires before or during the download
+
+
+def transfer_recording(downloadlink, filename, upload_id=None, on_upload_started=None, resumable=False,
+                       on_progress=None, expected_size=None, refresh_link=None, on_uploaded=None):
+    sink = get_storage_sink()
+    if sink is None:
+        raise TransferVerificationError(
+            f"Cannot store {filename}, set the AWS variables or DOWNLOAD_FOLDER")
+    sidecar = sink.read_sidecar(filename) if expected_size is not None and sink.stat(
+        filename) == expected_size else None
+    # The checksum of the stored recording is only compared when the sink can compute it cheaply
+    if sidecar and sidecar.get("size") == expected_size and sink.checksum(filename) in (None, sidecar.get("sha256")):
+        print(
+            f"Skipping download of {filename}, it is already stored and verified with the expected size")
+        stored_recordings_catalog.add(sink.key(filename))
+        return {"size": expected_size, "sha256": sidecar.get("sha256"), "skipped": True}
+    writer = sink.open(filename, resumable, upload_id, on_upload_started)
+    size = writer.offset
+    digest = hashlib.sha256()
+    if writer.offset:
+        existing = writer.read_existing()
+        if existing is None:
+            digest = None
+        else:
+            for chunk in existing:
+                digest.update(chunk)
+    metrics.inc("transfers_in_progress")
+    download_seconds = upload_seconds = 0
+    try:
+        started = time.monotonic()
+        with ResumableDownload(downloadlink, writer.offset, refresh_link) as download:
+            stream = ThrottledStream(download)
+            if on_progress:
+                stream = ProgressStream(stream, on_progress)
+            parts = read_parts(stream, writer.part_size)
+            while True:
+                # Time spent waiting for the download and writing to storage, to tell which one is the bottleneck
+                part = next(parts, None)
+                downloaded = time.monotonic()
+                download_seconds += downloaded - started
+                if part is None:
+                    break
+                metrics.inc("recording_download_bytes_total", len(part))
+                if digest:
+                    digest.update(part)
+                size += len(part)
+                if expected_size is not None and size > expected_size:
+                    raise TransferVerificationError(
+                        f"Downloaded more than the {expected_size} bytes of {filename}")
+                writer.write(part)
+                started = time.monotonic()
+                upload_seconds += started - downloaded
+                metrics.inc("recording_upload_bytes_total", len(part))
+        if expected_size is not None and size != expected_size:
+            raise TransferVerificationError(
+                f"Downloaded {size} bytes of {filename} instead of {expected_size}")
+        started = time.monotonic()
+        writer.commit()
+        upload_seconds += time.monotonic() - started
+    except TransferVerificationError:
+        writer.abort()
+        raise
+    except:
+        if resumable:
+            writer.close()
+        else:
+            writer.abort()
+        raise
+    finally:
+        metrics.inc("transfers_in_progress", -1)
+        metrics.inc("recording_download_seconds_total", download_seconds)
+        metrics.inc("recording_upload_seconds_total", upload_seconds)
+    # The sidecar is written before the recording is verified, so a transfer interrupted in between is verified by
+    # the skip check above when it is resumed, without downloading it again
+    info = {"size": size, "sha256": digest.hexdigest() if digest else None,
+            "stored": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+    sink.write_sidecar(filename, info)
+    if on_uploaded:
+        on_uploaded(writer.key)
+    stored_size = sink.stat(filename)
+    if stored_size != size:
+        sink.delete(filename)
+        raise TransferVerificationError(
+            f"Stored {stored_size} bytes of {filename} instead of {size}")
+    stored_recordings_catalog.add(writer.key)
+    log_event("recording_transferred", filename=filename, bytes=size - writer.offset, resumed_from=writer.offset,
+              download_seconds=round(download_seconds, 3), upload_seconds=round(upload_seconds, 3))
+    return dict(info, skipped=False, transferred=size - writer.offset,
+                download_seconds=download_seconds, upload_seconds=upload_seconds)
+
+# Transfer a recording with transfer_recording(), in the app process or in a transfer worker process depending on
+# TRANSFER_MODE. In a worker process, on_upload_started, on_progress and on_uploaded are called back in the app
+# process, and the metrics of the transfer are recorded in the app process once it is done
+
+
+def run_transfer(downloadlink, filename, upload_id=None, on_upload_started=None, resumable=False,
+                 on_progress=None, expected_size=None, refresh_link=None, on_uploaded=None):
+    if TRANSFER_MODE != "process":
+        return transfer_recording(downloadlink, filename, upload_id, on_upload_started, resumable, on_progress,
+                                  expected_size, refresh_link, on_uploaded)
+    token = next(transfer_tokens)
+    callbacks = {"upload_started": on_upload_started, "progress": on_progress,
+                 "uploaded": on_uploaded, "done": threading.Event()}
+    with transfer_pool_lock:
+        transfer_callbacks[token] = callbacks
+    metrics.inc("transfers_in_progress")
+    try:
+        info = get_transfer_pool().submit(transfer_recording_in_worker, token, downloadlink, filename, upload_id,
+                                          resumable, expected_size, current_job_bandwidth.get(), refresh_link,
+                                          dict(get_webex_token().data)).result()
+    finally:
+        metrics.inc("transfers_in_progress", -1)
+        # The callbacks sent before the end of the transfer are handled before returning
+        callbacks["done"].wait(60)
+        with transfer_pool_lock:
+            del transfer_callbacks[token]
+    if not info["skipped"]:
+        metrics.inc("recording_download_bytes_total", info["transferred"])
+        metrics.inc("recording_upload_bytes_total", info["transferred"])
+        metrics.inc("recording_download_seconds_total",
+                    info["download_seconds"])
+        metrics.inc("recording_upload_seconds_total", info["upload_seconds"])
+    return info
+
+
+transfer_pool = None
+transfer_pool_lock = threading.Lock()
+transfer_events = None
+transfer_tokens = itertools.count()
+transfer_callbacks = {}
+
+# Start the pool of transfer worker processes on first use, with a queue on which the workers send the callbacks
+# of their transfers. Workers are spawned rather than forked, so they do not inherit the threads and database
+# connections of the app process
+
+
+def get_transfer_pool():
+    global transfer_pool
+    with transfer_pool_lock:
+        if transfer_pool is None:
+            context = multiprocessing.get_context("spawn")
+            events = context.Queue()
+            get_limiter_manager()
+            transfer_pool = ProcessPoolExecutor(TRANSFER_PROCESSES, mp_context=context, initializer=init_transfer_worker,
+                                                initargs=(events, webex_rate_limiter, download_bandwidth_limiter))
+            threading.Thread(target=dispatch_transfer_events,
+                             args=(events,), daemon=True).start()
+        return transfer_pool
+
+# Call the callbacks sent by the transfer worker processes
+
+
+def dispatch_transfer_events(events):
+    while True:
+        token, kind, value = events.get()
+        with transfer_pool_lock:
+            callbacks = transfer_callbacks.get(token)
+        if callbacks is None:
+            continue
+        if kind == "done":
+            callbacks["done"].set()
+        elif callbacks[kind]:
+            try:
+                callbacks[kind](value)
+            except Exception:
+                app.logger.exception(f"Failed handling the {kind} of a transfer")
+
+# Set up a transfer worker process with the queue of callbacks and the proxies of the limiters of the app process
+
+
+def init_transfer_worker(events, api_limiter, bandwidth_limiter):
+    global transfer_events, webex_rate_limiter, download_bandwidth_limiter
+    transfer_events = events
+    webex_rate_limiter = api_limiter
+    download_bandwidth_limiter = bandwidth_limiter
+
+# Run a transfer in a transfer worker process, sending its callbacks to the app process. The Webex token is
+# used to refresh the download link from the worker, and job_limiter is the proxy of the bandwidth limiter of the
+# job, if it has a cap
+
+
+def transfer_recording_in_worker(token, downloadlink, filename, upload_id, resumable, expected_size, job_limiter,
+                                 refresh_link, token_data):
+    current_webex_token.set(WebexToken(token_data))
+    # Released after the transfer, so the limiter of the job is freed once the job ends
+    job_bandwidth = current_job_bandwidth.set(job_limiter)
+    try:
+        return transfer_recording(downloadlink, filename, upload_id,
+                                  lambda value: transfer_events.put(
+                                      (token, "upload_started", value)),
+                                  resumable, lambda value: transfer_events.put(
+                                      (token, "progress", value)),
+                                  expected_size, refresh_link, lambda value: transfer_events.put(
+                                      (token, "uploaded", value)))
+    finally:
+        current_job_bandwidth.reset(job_bandwidth)
+        transfer_events.put((token, "done", None))
+
+# Run worker(item) for all items on a thread pool, with at most max_workers running in total and at most
+# max_per_key running for the same key(item). Items with the same key are started in order and keys take turns,
+# so a single host with many recordings does not hold up everybody else. Results are yielded as they complete.
+# items can be any iterable, such as a generator fed by a listing still going on: it is read on a thread of its own,
+# at most max_waiting items ahead of the ones started, so items already read start as soon as a worker is free
+# even while the next item is not ready yet
+
+
+def run_concurrently(items, worker, key, max_workers, max_per_key, max_waiting=None):
+    if max_waiting is None:
+        max_waiting = max_workers * 4
+    # Items read, workers done and the end of the items arrive on the same queue, in the order they happen
+    events = queue.Queue()
+    read_ahead = threading.Semaphore(max_waiting)
+    stopped = threading.Event()
+
+    def read_items():
+        iterator = iter(items)
+        try:
+            while True:
+                read_ahead.acquire()
+                if stopped.is_set():
+                    return
+                item = next(iterator, None)
+                if item is None:
+                    break
+                events.put(("item", item))
+        except Exception as error:
+            events.put(("error", error))
+            return
+        events.put(("end", None))
+
+    exhausted = False
+    queues = OrderedDict()
+    running = {}
+    running_per_key = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # The items are read in a copy of the current context, so a generator listing them uses the same access token
+        reader = threading.Thread(
+            target=contextvars.copy_context().run, args=(read_items,), daemon=True)
+        reader.start()
+        try:
+            while True:
+                for item_key in list(queues):
+                    if len(running) >= max_workers:
+                        break
+                    if running_per_key.get(item_key, 0) >= max_per_key:
+                        continue
+                    item = queues[item_key].popleft()
+                    read_ahead.release()
+                    if not queues[item_key]:
+                        del queues[item_key]
+                    else:
+                        # Move the key to the back so the other keys get their turn first
+                        queues.move_to_end(item_key)
+                    running_per_key[item_key] = running_per_key.get(
+                        item_key, 0) + 1
+                    # Workers run in a copy of the current context, so they use the same access token
+                    future = executor.submit(
+                        contextvars.copy_context().run, worker, item)
+                    running[future] = item_key
+                    future.add_done_callback(
+                        lambda future: events.put(("done", future)))
+                if exhausted and not running:
+                    break
+                kind, value = events.get()
+                if kind == "item":
+                    queues.setdefault(key(value), deque()).append(value)
+                elif kind == "done":
+                    item_key = running.pop(value)
+                    running_per_key[item_key] -= 1
+                    yield value.result()
+                elif kind == "end":
+                    exhausted = True
+                else:
+                    raise value
+        finally:
+            # Let the reader stop if the results are not all consumed
+            stopped.set()
+            read_ahead.release()
+
+# List the recordings of a person in bulk mode that are not stored yet, tagged with the host email and name, page
+# by page. Each page is added to the journal of the job and the recordings new to the journal are handed to
+# on_listed(recordings) right away, so they can be transferred while the listing goes on. Returns whether listing
+# succeeded and either the number of recordings listed or the summary entry of the person that failed
+
+
+def list_user_recordings_not_stored(person, job_id, from_date, to_date, selected_site, stored_recordings,
+                                    incremental=False, on_listed=None):
+    print(f'Listing recordings for: {person["id"]}')
+    try:
+        host_details = get_host_email_name(person['id'])
+        host_email = host_details[0][0]
+        host_name = host_details[1]
+        watermark = migration_journal.get_watermark(
+            selected_site, host_email) if incremental else None
+        if watermark:
+            # Scheduled jobs only list the recordings since the end of the previous run that migrated all the
+            # recordings of the person, minus the lookback. Recordings listed again are already stored
+            from_date = format_timestamp(parse_timestamp(
+                watermark) - timedelta(seconds=WATERMARK_LOOKBACK))
+        listed = 0
+        started = time.monotonic()
+        for page in iter_meeting_pages(from_date, to_date, selected_site, host_email):
+            recordings_not_stored = []
+            for user_rec in page:
+                if user_rec["id"] not in stored_recordings:
+                    user_rec["host_email"] = host_email
+                    user_rec["host_name"] = host_name
+                    recordings_not_stored.append(user_rec)
+                else:
+                    print(
+                        f'Skipping recording ID {user_rec["id"]} for user {host_name} since it is already stored.')
+            added = migration_journal.add_listed_recordings(
+                job_id, recordings_not_stored)
+            listed += len(recordings_not_stored)
+            if on_listed and added:
+                on_listed(added)
+    except:
+        app.logger.exception(
+            f"Failed listing the recordings of person id {person['id']}")
+        return False, {"person_id": person['id'], "displayName": person.get('displayName')}
+    metrics.observe("webex_listing_duration_seconds",
+                    time.monotonic() - started)
+    migration_journal.set_person_listed(job_id, person['id'], host_email)
+    return True, listed
+
+# Copy a single recording of a bulk migration job to storage, verify it and record the outcome in the journal of
+# the job. Returns whether it was migrated and its summary entry
+
+
+def migrate_bulk_recording(meeting, progress=None):
+    started = time.monotonic()
+    # Recordings uploaded by an earlier run that stopped before verifying them are verified by transfer_recording()
+    # from their sidecar, without downloading them again
+    migrated, result = copy_bulk_recording(meeting, progress)
+    migration_journal.update_item(meeting["job_id"], meeting["id"], state=ITEM_VERIFIED if migrated else ITEM_FAILED,
+                                  filename=result["filename"], result=json.dumps(result))
+    record_migration(meeting["id"], migrated, time.monotonic() - started, job_id=meeting["job_id"])
+    return migrated, result
+
+# Record the outcome and end to end time of the migration of a recording
+
+
+def record_migration(recording_id, migrated, seconds, **fields):
+    result = "migrated" if migrated else "failed"
+    metrics.inc("recordings_migrated_total", result=result)
+    metrics.observe("recording_transfer_duration_seconds",
+                    seconds, result=result)
+    log_event("recording_migrated", recording_id=recording_id, result=result,
+              seconds=round(seconds, 3), **fields)
+
+# Copy a single recording found in bulk mode to storage. Returns whether it was copied and its summary entry
+
+
+def copy_bulk_recording(meeting, progress=None):
+    meeting_id = meeting["id"]
+    filename = ""
+    try:
+        recording_details = get_recording_details_host_email(
+            meeting["id"], meeting["host_email"])
+        topic = recording_details['topic']
+        timerecorded = recording_details['timeRecorded']
+        hostName = meeting["host_name"]
+        filename = f'{hostName}-{timerecorded}---{meeting_id}.mp4'
+        filename = filename.replace(':', '_')
+        filename = filename.replace(',', '_')
+        if 'temporaryDirectDownloadLinks' not in recording_details:
+            if (meeting["serviceType"] != "MeetingCenter"):
+                serviceType = meeting["serviceType"]
+                downloadURL = meeting["downloadUrl"]
+                recordingPwd = meeting["password"]
+                app.logger.info(
+                    f"Recording ID: {meeting_id} is for {serviceType} recording service. Try manual download with: {downloadURL} pwd: {recordingPwd} ")
+                print(
+                    f"Recording ID: {meeting_id} is for {serviceType} recording service. Try manual download with: {downloadURL} pwd: {recordingPwd} ")
+                return False, {"id": meeting_id, "filename": filename, "downloadURL": downloadURL, "pwd": recordingPwd}
+            else:
+                app.logger.info(
+                    f"Recording ID: {meeting_id} does not have any download links! Check PREVENT DOWNLOADING setting. ")
+                print(
+                    f"Recording ID: {meeting_id} does not have any download links! Check PREVENT DOWNLOADING setting. ")
+                return False, {"id": meeting_id, "filename": filename}
+        else:
+            # Stream recording mp4 to storage in bounded chunks
+
+            downloadlink = recording_details['temporaryDirectDownloadLinks']['recordingDownloadLink']
+            app.logger.info(
+                f"Attempting bulk download of recording ID: {meeting_id} to filename {filename}")
+            print(
+                f"Attempting bulk download of recording ID: {meeting_id} to filename {filename}")
+            migration_journal.update_item(
+                meeting["job_id"], meeting_id, state=ITEM_DOWNLOADING, filename=filename)
+            transferred = run_transfer(downloadlink, filename, upload_id=meeting["upload_id"],
+                                       on_upload_started=lambda upload_id: migration_journal.update_item(
+                                           meeting["job_id"], meeting_id, upload_id=upload_id),
+                                       resumable=True, on_progress=progress.add_bytes if progress else None,
+                                       expected_size=recording_details.get(
+                                           'sizeBytes', meeting.get('sizeBytes')),
+                                       refresh_link=partial(get_download_link, meeting_id, meeting["host_email"]),
+                                       # The multipart upload is complete, it cannot be resumed anymore
+                                       on_uploaded=lambda key: migration_journal.update_item(
+                                           meeting["job_id"], meeting_id, state=ITEM_UPLOADED, upload_id=None))
+            return True, {"id": meeting_id, "filename": filename, "size": transferred["size"], "sha256": transferred["sha256"]}
+
+    except:
+        app.logger.exception(
+            f"Failed copying of recording with meeting id {meeting_id}")
+        return False, {"id": meeting_id, "filename": filename}
+
+# Run a bulk migration job: list the recordings of the people that have not been listed yet for the job, then
+# transfer all the recordings of the job that have not been transferred yet. Returns the migrated and failed
+# recordings of the whole job, including those of earlier runs, and the people whose listing failed. The
+# optional JobProgress is updated as the job goes
+
+
+def run_bulk_job(job_id, progress=None):
+    if JOB_BANDWIDTH_LIMIT:
+        # Shared by the transfers of the job, which run in copies of this context or get it in the worker processes
+        current_job_bandwidth.set(new_rate_limiter(
+            JOB_BANDWIDTH_LIMIT * 1000 * 1000 / 8))
+    job = migration_journal.get_job(job_id)
+    migration_journal.set_job_status(job_id, JOB_RUNNING)
+    if progress:
+        progress.set_stage("listing")
+
+    # Get recordings in storage
+    stored_recordings = get_stored_recordings()
+    print(f'Stored recordings: {len(stored_recordings)}')
+    app.logger.info(
+        "Retrieving all users for bulk download....")
+    print("Retrieving all users for bulk download...")
+    schedule = migration_journal.get_schedule(
+        job["schedule_id"]) if job["schedule_id"] else None
+    if schedule and schedule["person_ids"] != ["all"]:
+        people = [{"id": person_id} for person_id in schedule["person_ids"]]
     else:
-        peopleiterable = api.people.list()
-    for person in peopleiterable:
-        people.append(json.loads(json.dumps(person.json_data)))
-    # print(people)
+        people = get_people(get_access_token())
+    people_to_list = migration_journal.people_to_list(
+        job_id, [person['id'] for person in people])
+    app.logger.info(
+        f"Retrieving list of recordings for {len(people_to_list)} users not listed yet....")
+    print(
+        f"Retrieving list of recordings for {len(people_to_list)} users not listed yet...")
+    # Recordings left unfinished by an earlier run of the job are transferred first, then the recordings are
+    # transferred as they are listed: listing threads put them on a bounded queue that feeds the transfers
+    items = migration_journal.unfinished_items(job_id)
+    listed_queue = queue.Queue(ENUMERATION_QUEUE_SIZE)
+
+    def on_listed(recordings):
+        if progress:
+            progress.add_expected(
+                sum(recording.get("sizeBytes") or 0 for recording in recordings))
+        for recording in recordings:
+            listed_queue.put(dict(recording, job_id=job_id, state=ITEM_LISTED,
+                                  filename=None, upload_id=None))
+            metrics.set("listing_queue_depth",
+                        listed_queue.qsize(), job=job_id)
+
+    list_recordings = partial(list_user_recordings_not_stored, job_id=job_id, from_date=job["from_date"],
+                              to_date=job["to_date"], selected_site=job["site"], stored_recordings=stored_recordings,
+                              incremental=job["schedule_id"] is not None, on_listed=on_listed)
+    failed_listings = []
+
+    def list_people():
+        try:
+            for listed, result in run_concurrently([person for person in people if person['id'] in people_to_list],
+                                                   list_recordings, lambda person: person['id'],
+                                                   ENUMERATION_CONCURRENCY, 1):
+                if not listed:
+                    failed_listings.append(result)
+                    if progress:
+                        progress.failed_listings.append(result)
+            app.logger.info(
+                "Successfully retrieved the list of recordings not already stored for bulk processing")
+            print(
+                "Successfully retrieved the list of recordings not already stored for bulk processing")
+        finally:
+            listed_queue.put(None)
+            if progress:
+                progress.set_listing_done()
+
+    def listed_recordings():
+        yield from items
+        for recording in iter(listed_queue.get, None):
+            metrics.set("listing_queue_depth",
+                        listed_queue.qsize(), job=job_id)
+            yield recording
+
+    if progress:
+        progress.set_stage("transferring", sum(
+            item.get("sizeBytes") or 0 for item in items))
+    # Listing runs in a copy of the current context, so it uses the same access token
+    lister = threading.Thread(
+        target=contextvars.copy_context().run, args=(list_people,), daemon=True)
+    lister.start()
+    try:
+        for migrated, result in run_concurrently(listed_recordings(), partial(migrate_bulk_recording, progress=progress),
+                                                 lambda meeting: meeting["host_email"],
+                                                 MIGRATION_CONCURRENCY, MIGRATION_PER_HOST_CONCURRENCY):
+            pass
+    finally:
+        # If the transfers stopped early, keep emptying the queue so the listing can finish. What it lists stays in
+        # the journal for the next run of the job
+        while lister.is_alive():
+            try:
+                listed_queue.get(timeout=1)
+            except queue.Empty:
+                pass
+        # Ends the reading of the listed recordings, if it is still waiting for one
+        listed_queue.put(None)
+        metrics.set("listing_queue_depth", 0, job=job_id)
+
+    failed_deletions = []
+    if (MIGRATE_RECORDINGS == "True"):
+        # Delete the recordings verified in storage, including the ones of an earlier run of the job
+        if progress:
+            progress.set_stage("deleting")
+        _, failed_deletions = delete_migrated_recordings(
+            migration_journal.verified_items(job_id),
+            lambda recording: migration_journal.update_item(job_id, recording["id"], state=ITEM_DELETED))
+        if progress:
+            progress.failed_deletions.extend(failed_deletions)
+
+    if job["schedule_id"]:
+        migration_journal.advance_watermarks(
+            job_id, job["site"], job["to_date"])
+    migrated_meetings, failed_migrations = migration_journal.summary(job_id)
+    status = JOB_INCOMPLETE if failed_migrations or failed_listings or failed_deletions else JOB_COMPLETED
+    migration_journal.finish_job(job_id, status)
+    if progress:
+        progress.set_stage(status)
+    print("================== Done! ====================")
+    print("Copied:")
+    print(migrated_meetings)
+    print("Failed:")
+    print(failed_migrations)
+    print("Failed listing recordings for:")
+    print(failed_listings)
+    if failed_deletions:
+        print("Failed deleting from Webex:")
+        print(failed_deletions)
+    log_event("job_finished", job_id=job_id, status=status, migrated=len(migrated_meetings),
+              failed=len(failed_migrations), failed_listings=len(failed_listings),
+              failed_deletions=len(failed_deletions))
+    app.logger.info(
+        f"Webex API metrics: {webex_api_metrics.summary()}")
+    return migrated_meetings, failed_migrations, failed_listings
+
+# Progress of a bulk migration job run in the background, kept in memory while the app runs
+
+
+class JobProgress:
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.stage = JOB_QUEUED
+        self.started = None
+        self.transfer_started = None
+        self.bytes_expected = 0
+        self.bytes_transferred = 0
+        self.failed_listings = []
+        self.failed_deletions = []
+        self.listing_done = False
+        self.lock = threading.Lock()
+
+    def set_stage(self, stage, bytes_expected=None):
+        with self.lock:
+            self.stage = stage
+            if stage == "listing":
+                self.started = time.time()
+            elif stage == "transferring":
+                self.transfer_started = time.time()
+                self.bytes_expected = bytes_expected or 0
+
+    # Recordings listed while the transfers are already going on
+    def add_expected(self, count):
+        with self.lock:
+            self.bytes_expected += count
+
+    def set_listing_done(self):
+        with self.lock:
+            self.listing_done = True
+
+    def add_bytes(self, count):
+        with self.lock:
+            self.bytes_transferred += count
+
+    @property
+    def active(self):
+        return self.stage not in (JOB_COMPLETED, JOB_INCOMPLETE)
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.time() - self.transfer_started if self.transfer_started else 0
+            throughput = self.bytes_transferred / elapsed if elapsed > 0 else 0
+            remaining = max(self.bytes_expected - self.bytes_transferred, 0)
+            return {
+                "stage": self.stage,
+                "started": self.started,
+                "bytes_expected": self.bytes_expected,
+                "bytes_transferred": self.bytes_transferred,
+                "throughput_bytes_per_second": throughput,
+                "listing_done": self.listing_done,
+                # Only known once every recording has been listed
+                "eta_seconds": remaining / throughput if throughput and self.stage == "transferring" and self.listing_done else None,
+                "failed_listings": list(self.failed_listings),
+                "failed_deletions": list(self.failed_deletions)
+            }
+
+# Webex token stored with a job. Refreshed tokens are saved back to the job, and to its schedule so the next runs
+# of the schedule start with the latest token
+
+
+def get_job_webex_token(job_id):
+    data = migration_journal.get_job_token(job_id)
+    if data is None:
+        return None
+    schedule_id = migration_journal.get_job(job_id)["schedule_id"]
+
+    def save_token(data):
+        migration_journal.set_job_token(job_id, data)
+        if schedule_id:
+            migration_journal.set_schedule_token(schedule_id, data)
+    return WebexToken(data, save_token)
+
+# Claim a bulk migration job for this worker process. Returns False when another worker process runs it
+
+
+def claim_job(job_id):
+    start_heartbeat()
+    return migration_journal.claim_job(job_id, WORKER_ID, time.time() - JOB_STALE_AFTER)
+
+# Update the heartbeat of the jobs this worker process owns every JOB_HEARTBEAT_INTERVAL seconds, on a background
+# thread started once
+
+
+def start_heartbeat():
+    global heartbeat_thread
+    with heartbeat_lock:
+        if heartbeat_thread is not None:
+            return
+
+        def beat():
+            while True:
+                time.sleep(JOB_HEARTBEAT_INTERVAL)
+                try:
+                    migration_journal.heartbeat(WORKER_ID)
+                except:
+                    app.logger.exception(
+                        "Failed updating the heartbeat of the bulk migration jobs")
+
+        heartbeat_thread = threading.Thread(target=beat, daemon=True)
+        heartbeat_thread.start()
+
+
+heartbeat_thread = None
+heartbeat_lock = threading.Lock()
+
+# Runs bulk migration jobs on background worker threads, so the web requests that start them return right away.
+# Each job runs with the token stored with it, of the admin that started it or created its schedule
+
+
+class JobRunner:
+    def __init__(self, workers):
+        self.workers = workers
+        self.queue = queue.Queue()
+        self.progress = {}
+        self.threads = []
+        self.lock = threading.Lock()
+
+    # Queue a job, unless it is already queued or running here or in another worker process. Returns whether it
+    # was queued
+    def enqueue(self, job_id):
+        with self.lock:
+            if job_id in self.progress and self.progress[job_id].active:
+                return False
+            if not claim_job(job_id):
+                return False
+            self.progress[job_id] = JobProgress(job_id)
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        self.queue.put(job_id)
+        metrics.set("jobs_queued", self.queue.qsize())
+        return True
+
+    def work(self):
+        while True:
+            job_id = self.queue.get()
+            metrics.set("jobs_queued", self.queue.qsize())
+            progress = self.progress[job_id]
+            try:
+                # Each job runs in a context of its own, so its token and bandwidth limiter are dropped when it ends
+                contextvars.Context().run(self.run_job, job_id, progress)
+            except:
+                app.logger.exception(f"Bulk migration job {job_id} failed")
+                migration_journal.finish_job(job_id, JOB_INCOMPLETE)
+                progress.set_stage(JOB_INCOMPLETE)
+            finally:
+                self.queue.task_done()
+
+    def run_job(self, job_id, progress):
+        current_webex_token.set(get_job_webex_token(job_id))
+        run_bulk_job(job_id, progress)
+
+    # Return the progress of a job, combining the journal with what is known while it runs
+    def get_progress(self, job_id):
+        job = migration_journal.get_job(job_id)
+        if job is None:
+            return None
+        counts = migration_journal.item_counts(job_id)
+        job["items"] = {
+            "total": sum(counts.values()),
+            "done": sum(counts.get(state, 0) for state in ITEM_DONE_STATES),
+            "failed": counts.get(ITEM_FAILED, 0),
+            "pending": sum(counts.get(state, 0) for state in (ITEM_LISTED, ITEM_DOWNLOADING, ITEM_UPLOADED)),
+            "by_state": counts
+        }
+        with self.lock:
+            progress = self.progress.get(job_id)
+        if progress:
+            job.update(progress.snapshot())
+        return job
+
+
+job_runner = JobRunner(JOB_WORKERS)
+
+# Time between the runs of a schedule, per frequency
+SCHEDULE_INTERVALS = {
+    "daily": 24 * 60 * 60,
+    "weekly": 7 * 24 * 60 * 60,
+    "biweekly": 14 * 24 * 60 * 60,
+    "monthly": 30 * 24 * 60 * 60
+}
+
+# Queue a bulk migration job for every schedule that is due. The job lists each person from their watermark
+# (or from the start date of the schedule for people never migrated) up to now, with the token of the schedule
+
+
+def run_due_schedules():
+    now = time.time()
+    for schedule in migration_journal.get_schedules():
+        if schedule["next_run"] > now:
+            continue
+        interval = SCHEDULE_INTERVALS[schedule["frequency"]]
+        # Skip the runs that were missed while the app was not running
+        next_run = schedule["next_run"] + interval * \
+            (int((now - schedule["next_run"]) // interval) + 1)
+        if not migration_journal.claim_schedule_run(schedule["id"], schedule["next_run"], next_run):
+            continue
+        if migration_journal.schedule_has_active_job(schedule["id"]):
+            print(
+                f"Skipping scheduled migration {schedule['id']}, its previous run is still going")
+            continue
+        token = migration_journal.get_schedule_token(schedule["id"])
+        if token is None:
+            print(
+                f"Skipping scheduled migration {schedule['id']}, it has no Webex token, create it again")
+            continue
+        to_date = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now))
+        job_id = migration_journal.create_job(schedule["site"], schedule["start_date"], to_date,
+                                              schedule_id=schedule["id"], admin_id=schedule["admin_id"], token=token)
+        print(
+            f"Starting scheduled migration {schedule['id']} as job {job_id}")
+        job_runner.enqueue(job_id)
 
-    return people
+# Resume the bulk migration jobs whose worker process stopped, such as when the app was restarted, with their token
 
-# Get the host email from the people details
 
+def resume_interrupted_jobs():
+    for job_id in migration_journal.interrupted_jobs(time.time() - JOB_STALE_AFTER):
+        if job_runner.enqueue(job_id):
+            print(f"Resuming interrupted bulk migration job {job_id}")
 
-def get_host_email(person_id):
-    # Get people details
-    url = f"{WEBEX_BASE_URL}/people/{person_id}"
-    headers = {
-        "Authorization": f"Bearer {webex_access_token}"
-    }
+# Check the schedules and the interrupted jobs every SCHEDULER_POLL_INTERVAL seconds, on a background thread
+# started once
+
+
+def start_scheduler():
+    global scheduler_thread
+    with scheduler_lock:
+        if scheduler_thread is not None:
+            return
+
+        def check_schedules():
+            while True:
+                try:
+                    run_due_schedules()
+                except:
+                    app.logger.exception("Failed running scheduled migrations")
+                try:
+                    resume_interrupted_jobs()
+                except:
+                    app.logger.exception("Failed resuming interrupted bulk migration jobs")
+                time.sleep(SCHEDULER_POLL_INTERVAL)
+
+        scheduler_thread = threading.Thread(
+            target=check_schedules, daemon=True)
+        scheduler_thread.start()
+
+
+scheduler_thread = None
+scheduler_lock = threading.Lock()
+
+# Start the scheduler with the first request a worker process handles, so the schedules run and the interrupted jobs
+# resume without anybody logged in once the app restarted
+
+
+@app.before_request
+def start_background_work():
+    if scheduler_thread is None:
+        start_scheduler()
+
+# Get all the people in your organization. The directory is cached for PEOPLE_CACHE_TTL seconds, and the emails
+# and display name of everybody listed are cached too, so later host lookups do not need another request
+
+
+def get_people(webex_access_token):
+    # Get people
+    name_filter = BULK_NAME_FILTER if BULK_NAME_FILTER != '' and len(
+        BULK_NAME_FILTER) >= 3 else ''
+    # Cached per token, so admins of different organizations never see each other's people
+    people = people_cache.get((webex_access_token, name_filter))
+    if people is not None:
+        return list(people)
+
+    # Listed page by page through the shared HTTP session and rate limiter, following the 'next' links of the API
+    url = f"{WEBEX_BASE_URL}/people?max={WEBEX_PEOPLE_PAGE_SIZE}"
+    if name_filter:
+        url += f"&displayName={urllib.parse.quote(name_filter)}"
+    people = []
+    while url:
+        response = webex_api_request("GET", url, "people")
+        response.raise_for_status()
+        for person in response.json()["items"]:
+            people.append(person)
+            person_cache.set(person['id'], {
+                "emails": person['emails'], "displayName": person.get('displayName')})
+        url = response.links.get("next", {}).get("url")
 
-    response = requests.get(url, headers=headers)
+    people_cache.set((webex_access_token, name_filter), people)
+    return list(people)
+
+# Get the Webex person ID of the admin the access token belongs to, which owns the jobs and schedules they create
+
+
+def get_admin_id():
+    response = webex_api_request(
+        "GET", f"{WEBEX_BASE_URL}/people/me", "people/me")
     response.raise_for_status()
-    # print("get host email")
-    # print(response.json())
-    emails = response.json()["emails"]
-    print(f'Got host email: {emails}')
-    return emails
+    return response.json()["id"]
 
+# Get the emails and display name of a person, from the cache when possible
+
+
+def get_person_details(person_id):
+    person = person_cache.get(person_id)
+    if person is not None:
+        return person
 
-def get_host_email_name(person_id):
     # Get people details
     url = f"{WEBEX_BASE_URL}/people/{person_id}"
-    headers = {
-        "Authorization": f"Bearer {webex_access_token}"
-    }
 
-    response = requests.get(url, headers=headers)
+    response = webex_api_request("GET", url, "people/{personId}")
     response.raise_for_status()
-    # print("get host email")
-    # print(response.json())
-    emails = response.json()["emails"]
-    displayName = response.json()["displayName"]
-    print(f'Got host email: {emails}')
-    return emails, displayName
+    person = {"emails": response.json()[
+        "emails"], "displayName": response.json()["displayName"]}
+    print(f'Got host email: {person["emails"]}')
+    person_cache.set(person_id, person)
+    return person
+
+# Get the host email from the people details
+
+
+def get_host_email(person_id):
+    return get_person_details(person_id)["emails"]
+
+
+def get_host_email_name(person_id):
+    person = get_person_details(person_id)
+    return person["emails"], person["displayName"]
 
 # Delete a specific webex recording based on the recording ID
 
@@ -248,35 +2721,65 @@ def get_host_email_name(person_id):
 def delete_webex_recordings(recording_id, host_email):
     # Delete recording
     url = f"{WEBEX_BASE_URL}/recordings/{recording_id}?hostEmail={host_email}"
-    headers = {
-        "Authorization": f"Bearer {webex_access_token}"
-    }
 
-    response = requests.delete(url, headers=headers)
+    response = webex_api_request("DELETE", url, "recordings/{recordingId}")
     print("delete recording response")
     print(response.status_code)
     return response
 
+# Delete migrated recordings from Webex, DELETION_CONCURRENCY at a time through the shared rate limiter. Each
+# recording needs its "id" and "host_email". on_deleted(recording) is called for every recording deleted. Returns
+# the recordings deleted and the ones that could not be deleted, with the status code or error of the request
+
+
+def delete_migrated_recordings(recordings, on_deleted=None):
+    def delete(recording):
+        try:
+            response = delete_webex_recordings(
+                recording["id"], recording["host_email"])
+        except Exception as error:
+            app.logger.exception(
+                f"Failed deleting recording with meeting id {recording['id']}")
+            return False, dict(recording, error=str(error))
+        if not response.ok:
+            app.logger.info(
+                f"Failed deleting recording with meeting id {recording['id']}: {response.status_code}")
+            return False, dict(recording, error=response.status_code)
+        app.logger.info(
+            f"Successfully deleted meeting with meeting id {recording['id']}")
+        if on_deleted:
+            on_deleted(recording)
+        return True, recording
+
+    deleted, failed = [], []
+    for ok, result in run_concurrently(recordings, delete, lambda recording: recording["id"],
+                                       DELETION_CONCURRENCY, 1):
+        (deleted if ok else failed).append(result)
+    return deleted, failed
+
 # Get the recording details based on a meeting_id
 
 
 def get_recording_details(meeting, selected_person_id):
     # Get recording details
     url = f"{WEBEX_BASE_URL}/recordings/{meeting}?hostEmail={get_host_email(selected_person_id)[0]}"
-    response = requests.get(url, headers={
-        "Authorization": f"Bearer {webex_access_token}"
-    })
+    response = webex_api_request("GET", url, "recordings/{recordingId}")
     return response.json()
 
 
 def get_recording_details_host_email(meeting, host_email):
     # Get recording details
     url = f"{WEBEX_BASE_URL}/recordings/{meeting}?hostEmail={host_email}"
-    response = requests.get(url, headers={
-        "Authorization": f"Bearer {webex_access_token}"
-    })
+    response = webex_api_request("GET", url, "recordings/{recordingId}")
     return response.json()
 
+# Get a fresh temporary download link of a recording, when the one fetched with its details has expired
+
+
+def get_download_link(meeting, host_email):
+    recording_details = get_recording_details_host_email(meeting, host_email)
+    return recording_details['temporaryDirectDownloadLinks']['recordingDownloadLink']
+
 
 ##############
 ### Routes ###
@@ -294,14 +2797,13 @@ def mainpage():
 # bulk download login
 @app.route('/bulk')
 def bulk_mainpage():
-    global meetings
-    global people
+    state = get_session_state()
 
     session['bulk'] = True
 
-    # clearing out globals in case they just ran the regular version of the tool
-    meetings = []
-    people = []
+    # clearing out the session state in case they just ran the regular version of the tool
+    state["meetings"] = []
+    mark_session_state_changed()
 
     return render_template('mainpage_login.html')
 
@@ -310,10 +2812,56 @@ def bulk_mainpage():
 
 @app.route('/scheduler')
 def scheduler_page():
-    global webex_access_token
+    admin_id = get_session_state().get("admin_id")
+    if not admin_id:
+        return redirect('/')
+    sites = get_sites()
+    people = get_people(get_access_token())
+    return render_template('scheduler.html', sites=sites, people=people, schedules=migration_journal.get_schedules(admin_id))
+
+# Create a schedule that migrates the new recordings of the selected people periodically. The first run
+# migrates the recordings of the last period, later runs continue from the latest recording migrated per person
+
+
+@app.route('/submit_scheduler', methods=['POST'])
+def submit_scheduler():
+    admin_id = get_session_state().get("admin_id")
+    if not admin_id:
+        return redirect('/')
+    form_data = request.form
+    app.logger.info(form_data)
+
+    selected_site = form_data['site']
+    frequency = form_data['frequency']
+    person_ids = request.form.getlist('person')
+    if 'all' in person_ids:
+        person_ids = ['all']
+    now = time.time()
+    start_date = time.strftime(
+        "%Y-%m-%dT%H:%M:%SZ", time.gmtime(now - SCHEDULE_INTERVALS[frequency]))
+    # The schedule runs with its own copy of the token, refreshed independently of the session
+    schedule_id = migration_journal.add_schedule(
+        selected_site, person_ids, frequency, start_date, now, admin_id, dict(get_webex_token().data))
+    app.logger.info(
+        f"Created {frequency} schedule {schedule_id} for site {selected_site}")
+
     sites = get_sites()
-    people = get_people(webex_access_token)
-    return render_template('scheduler.html', sites=sites, people=people)
+    people = get_people(get_access_token())
+    return render_template('scheduler.html', sites=sites, people=people, schedules=migration_journal.get_schedules(admin_id),
+                           selected_site=selected_site, selected_frequency=frequency,
+                           message=f"Scheduled a {frequency} migration, the first run starts now.")
+
+# Delete a schedule of the admin
+
+
+@app.route('/delete_schedule/<int:schedule_id>', methods=['POST'])
+def delete_schedule(schedule_id):
+    admin_id = get_session_state().get("admin_id")
+    if not admin_id:
+        return redirect('/')
+    if not migration_journal.delete_schedule(schedule_id, admin_id):
+        return jsonify({"message": "Schedule not found"}), 404
+    return redirect('/scheduler')
 
 # webex access token
 
@@ -333,23 +2881,23 @@ def webexlogin():
 
 @app.route('/webexoauth', methods=['GET'])
 def webexoauth():
-    global sites
-    global webex_access_token
-    global people
+    state = get_session_state()
 
     webex_code = request.args.get('code')
-    webex_access_token = get_webex_access_token(webex_code)
+    mark_session_state_changed()
+    state["token"] = get_webex_access_token(webex_code)
+    state["admin_id"] = get_admin_id()
 
-    sites = get_sites()
+    state["sites"] = get_sites()
 
     if session['bulk']:
-        return render_template('bulkpage.html', sites=sites,
+        return render_template('bulkpage.html', sites=state["sites"],
                                Action="Migrate" if (
                                    MIGRATE_RECORDINGS == "True") else "Copy",
                                Destination="AWS" if (AWS_ACCESS_KEY_ID != "") else "Local")
     else:
-        people = get_people(webex_access_token)
-        return render_template('columnpage.html', sites=sites, people=people,
+        # The people are loaded by the page, one page at a time from /people
+        return render_template('columnpage.html', sites=state["sites"],
                                Action="Migrate" if (
                                    MIGRATE_RECORDINGS == "True") else "Copy",
                                Destination="AWS" if (AWS_ACCESS_KEY_ID != "") else "Local")
@@ -359,131 +2907,37 @@ def webexoauth():
 
 @app.route('/select_period', methods=['POST', 'GET'])
 def select_period():
-    global sites
-    global selected_site
-    global selected_person_id
-    global meetings
-    global people
+    state = get_session_state()
 
     if request.method == 'POST':
+        mark_session_state_changed()
         form_data = request.form
         app.logger.info(form_data)
 
         from_date = form_data['fromdate']
         to_date = form_data['todate']
-        selected_site = form_data['site']
+        selected_site = state["selected_site"] = form_data['site']
 
         if session['bulk']:
 
-            # Get recordings in storage
-            stored_recordings = get_stored_recordings()
-            print(f'Stored recordings: {stored_recordings}')
-            app.logger.info(
-                "Retrieving all users for bulk download....")
-            print("Retrieving all users for bulk download...")
-            people = get_people(webex_access_token)
-            app.logger.info(
-                "Retrieving list of recordings for each user....")
-            print("Retrieving list of recordings for each user...")
-            for person in people:
-                selected_person_id = person['id']
-                print(f'Listing recordings for: {selected_person_id}')
-                host_details = get_host_email_name(selected_person_id)
-                host_email = host_details[0][0]
-                host_name = host_details[1]
-                user_recordings = get_meetings(from_date,
-                                               to_date, selected_site, host_email)
-                recordings_not_stored = []
-                for user_rec in user_recordings:
-                    if user_rec["id"] not in stored_recordings:
-                        user_rec["host_email"] = host_email
-                        user_rec["host_name"] = host_name
-                        recordings_not_stored.append(user_rec)
-                    else:
-                        print(
-                            f'Skipping recording ID {user_rec["id"]} for user {host_name} since it is already stored.')
-                meetings += recordings_not_stored
-
-            app.logger.info(
-                "Successfully retrieved the list of recordings not already stored for bulk processing")
-            print(
-                "Successfully retrieved the list of recordings not already stored for bulk processing")
-
-            failed_migrations = []
-            migrated_meetings = []
-            for meeting in meetings:
-                meeting_id = meeting["id"]
-                try:
-                    recording_details = get_recording_details_host_email(
-                        meeting["id"], meeting["host_email"])
-                    topic = recording_details['topic']
-                    timerecorded = recording_details['timeRecorded']
-                    hostName = meeting["host_name"]
-                    filename = f'{hostName}-{timerecorded}---{meeting_id}.mp4'
-                    filename = filename.replace(':', '_')
-                    filename = filename.replace(',', '_')
-                    if 'temporaryDirectDownloadLinks' not in recording_details:
-                        if (meeting["serviceType"] != "MeetingCenter"):
-                            serviceType = meeting["serviceType"]
-                            downloadURL = meeting["downloadUrl"]
-                            recordingPwd = meeting["password"]
-                            app.logger.info(
-                                f"Recording ID: {meeting_id} is for {serviceType} recording service. Try manual download with: {downloadURL} pwd: {recordingPwd} ")
-                            print(
-                                f"Recording ID: {meeting_id} is for {serviceType} recording service. Try manual download with: {downloadURL} pwd: {recordingPwd} ")
-                            failed_migrations.append(
-                                {"id": meeting_id, "filename": filename, "downloadURL": downloadURL, "pwd": recordingPwd})
-                        else:
-                            app.logger.info(
-                                f"Recording ID: {meeting_id} does not have any download links! Check PREVENT DOWNLOADING setting. ")
-                            print(
-                                f"Recording ID: {meeting_id} does not have any download links! Check PREVENT DOWNLOADING setting. ")
-                            failed_migrations.append(
-                                {"id": meeting_id, "filename": filename})
-                    else:
-                        # Download recording mp4 in memory
-
-                        downloadlink = recording_details['temporaryDirectDownloadLinks']['recordingDownloadLink']
-                        downloaded_file = urllib.request.urlopen(downloadlink)
-                        app.logger.info(
-                            f"Attempting bulk download of recording ID: {meeting_id} to filename {filename}")
-                        print(
-                            f"Attempting bulk download of recording ID: {meeting_id} to filename {filename}")
-                        if (AWS_ACCESS_KEY_ID != ""):
-                            # We downloaded the file in memory and pass that on to S3 immediately
-                            s3.Bucket(BUCKET_NAME).put_object(
-                                Key=filename, Body=downloaded_file.read())
-                            migrated_meetings.append(
-                                {"id": meeting_id, "filename": filename})
-                        elif (DOWNLOAD_FOLDER != ""):
-                            downloaded_file = urllib.request.urlopen(
-                                downloadlink)
-                            save_as = DOWNLOAD_FOLDER + filename
-                            content = downloaded_file.read()
-                            # Save to file
-                            with open(save_as, 'wb') as download:
-                                download.write(content)
-                            migrated_meetings.append(
-                                {"id": meeting_id, "filename": filename})
-
-                except:
-                    app.logger.exception(
-                        f"Failed copying of recording with meeting id {meeting_id}")
-                    failed_migrations.append(
-                        {"id": meeting_id, "filename": filename})
-            print("================== Done! ====================")
-            print("Copied:")
-            print(migrated_meetings)
-            print("Failed:")
-            print(failed_migrations)
-            recordings_summary = f"Copied: {migrated_meetings}  Failed: {failed_migrations}"
-
-            meetings = []
-            people = []
-
-            return render_template('bulkpage.html', sites=sites, selected_site=selected_site, recordings_summary=recordings_summary)
+            # The job runs with its own copy of the token, refreshed independently of the session
+            token = dict(get_webex_token().data)
+            job_id = migration_journal.find_resumable_job(
+                selected_site, from_date, to_date, state.get("admin_id"))
+            if job_id is None:
+                job_id = migration_journal.create_job(
+                    selected_site, from_date, to_date, admin_id=state.get("admin_id"), token=token)
+            else:
+                migration_journal.set_job_token(job_id, token)
+                print(f"Resuming bulk migration job {job_id}")
+            # The job runs in the background, the page follows its progress
+            job_runner.enqueue(job_id)
+
+            state["meetings"] = []
+
+            return render_template('bulkpage.html', sites=state["sites"], selected_site=selected_site, job_id=job_id)
         else:
-            selected_person_id = form_data['person']
+            selected_person_id = state["selected_person_id"] = form_data['person']
             print(f'Selected person ID: {selected_person_id}')
             host_email = get_host_email(selected_person_id)[0]
             meetings = get_meetings(
@@ -494,8 +2948,12 @@ def select_period():
             # Get recordings in storage
             stored_recordings = get_stored_recordings()
 
-            meetings = are_meetings_in_storage(meetings, stored_recordings)
-            return render_template('columnpage.html', sites=sites, selected_site=selected_site, meetings=meetings, people=people, selected_person_id=selected_person_id,
+            meetings = state["meetings"] = are_meetings_in_storage(
+                meetings, stored_recordings)
+            # The recordings are loaded by the page, one page at a time from /recordings
+            return render_template('columnpage.html', sites=state["sites"], selected_site=selected_site, meetings_count=len(meetings),
+                                   selected_person=dict(get_person_details(
+                                       selected_person_id), id=selected_person_id),
                                    Action="Migrate" if (
                                        MIGRATE_RECORDINGS == "True") else "Copy",
                                    Destination="AWS" if (AWS_ACCESS_KEY_ID != "") else "Local")
@@ -504,16 +2962,108 @@ def select_period():
     else:
         return render_template('columnpage.html')
 
+# Metrics of the app in the Prometheus text format, for a Prometheus server to scrape
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+# Progress of a bulk migration job: recordings done, bytes transferred, throughput and ETA
+
+
+@app.route('/jobs/<int:job_id>/progress', methods=['GET'])
+def job_progress(job_id):
+    admin_id = get_session_state().get("admin_id")
+    if not admin_id:
+        return jsonify({"message": "Not logged in"}), 401
+    progress = job_runner.get_progress(job_id)
+    if progress is None or progress["admin_id"] != admin_id:
+        return jsonify({"message": "Job not found"}), 404
+    return jsonify(progress)
+
+# Summary of the recordings migrated and failed in a bulk migration job
+
+
+@app.route('/jobs/<int:job_id>/summary', methods=['GET'])
+def job_summary(job_id):
+    admin_id = get_session_state().get("admin_id")
+    if not admin_id:
+        return jsonify({"message": "Not logged in"}), 401
+    job = migration_journal.get_job(job_id)
+    if job is None or job["admin_id"] != admin_id:
+        return jsonify({"message": "Job not found"}), 404
+    migrated_meetings, failed_migrations = migration_journal.summary(job_id)
+    return jsonify({"migrated": migrated_meetings, "failed": failed_migrations})
+
+# Page of the items matching the search of the request, sorted on one of sort_fields. The query string holds the
+# page (from 1), per_page, search (case insensitive, in search_fields), sort and order ("asc" or "desc")
+
+
+def paginate(items, search_fields, sort_fields, default_sort, default_order="asc"):
+    page = max(request.args.get("page", 1, type=int), 1)
+    per_page = min(max(request.args.get(
+        "per_page", UI_PAGE_SIZE, type=int), 1), UI_MAX_PAGE_SIZE)
+    search = request.args.get("search", "").strip().lower()
+    sort = request.args.get("sort", default_sort)
+    if sort not in sort_fields:
+        sort = default_sort
+    order = request.args.get("order", default_order)
+
+    if search:
+        items = [item for item in items
+                 if any(search in str(item.get(field) or "").lower() for field in search_fields)]
+
+    def sort_key(item):
+        value = item.get(sort)
+        return (value is None, value.lower() if isinstance(value, str) else value or 0)
+
+    items = sorted(items, key=sort_key, reverse=order == "desc")
+    start = (page - 1) * per_page
+    return jsonify({"items": items[start:start + per_page], "total": len(items), "page": page,
+                    "per_page": per_page, "sort": sort, "order": order})
+
+# People of the organization for the person picker of the single-user page, from the cached people directory
+
+
+@app.route('/people', methods=['GET'])
+def people_page():
+    if not get_access_token():
+        return jsonify({"message": "Not logged in"}), 401
+    people = [{"id": person["id"], "displayName": person.get("displayName"),
+               "email": (person.get("emails") or [None])[0]} for person in get_people(get_access_token())]
+    return paginate(people, ("displayName", "email"), ("displayName", "email"), "displayName")
+
+# Recordings listed for the selected person, for the recordings table of the single-user page
+
+
+@app.route('/recordings', methods=['GET'])
+def recordings_page():
+    recordings = [{"id": meeting["id"], "topic": meeting.get("topic"), "timeRecorded": meeting.get("timeRecorded"),
+                   "sizeBytes": meeting.get("sizeBytes"), "inStorage": meeting.get("inStorage", False)}
+                  for meeting in get_session_state()["meetings"]]
+    return paginate(recordings, ("topic", "id"), ("timeRecorded", "topic", "sizeBytes"), "timeRecorded", "desc")
+
+# Progress of the latest bulk migration jobs of the admin
+
+
+@app.route('/jobs', methods=['GET'])
+def jobs():
+    admin_id = get_session_state().get("admin_id")
+    if not admin_id:
+        return jsonify({"message": "Not logged in"}), 401
+    return jsonify([job_runner.get_progress(job_id) for job_id in migration_journal.recent_jobs(admin_id)])
+
 # Step 2: Select recordings to migrate from Webex to AWS
 
 
 @app.route('/select_recordings', methods=['POST', 'GET'])
 def select_recordings():
-    global sites
-    global selected_site
-    global meetings
+    state = get_session_state()
+    selected_person_id = state["selected_person_id"]
 
     if request.method == 'POST':
+        mark_session_state_changed()
         form_data = request.form
         app.logger.info(form_data)
 
@@ -526,6 +3076,7 @@ def select_recordings():
             app.logger.info(meetings_to_migrate)
 
             for meeting in meetings_to_migrate:
+                started = time.monotonic()
                 try:
                     recording_details = get_recording_details(
                         meeting, selected_person_id)
@@ -533,32 +3084,28 @@ def select_recordings():
                     app.logger.info(
                         f"Downloading recording with meeting ID: {meeting}")
 
-                    # Download recording mp4 in memory
+                    # Stream recording mp4 to storage in bounded chunks
                     downloadlink = recording_details['temporaryDirectDownloadLinks']['recordingDownloadLink']
                     topic = recording_details['topic']
-                    downloaded_file = urllib.request.urlopen(downloadlink)
-
-                    if (AWS_ACCESS_KEY_ID != ""):
-                        # We downloaded the file in memory and pass that on to S3 immediately
-                        s3.Bucket(BUCKET_NAME).put_object(
-                            Key=f'{topic}---{meeting}.mp4', Body=downloaded_file.read())
-                    elif (DOWNLOAD_FOLDER != ""):
-                        downloaded_file = urllib.request.urlopen(downloadlink)
-                        save_as = DOWNLOAD_FOLDER+f'{topic}---{meeting}.mp4'
-                        content = downloaded_file.read()
-                        # Save to file
-                        with open(save_as, 'wb') as download:
-                            download.write(content)
+                    # Raises unless the recording was stored and verified, so only those count as migrated, and may be
+                    # deleted from Webex
+                    run_transfer(downloadlink, f'{topic}---{meeting}.mp4',
+                                 expected_size=recording_details.get(
+                                     'sizeBytes'),
+                                 refresh_link=partial(get_download_link, meeting, get_host_email(selected_person_id)[0]))
+                    record_migration(meeting, True, time.monotonic() - started)
 
                 except:
                     app.logger.exception(
                         f"Failed copying of recording with meeting id {meeting}")
                     failed_migration_IDs.append(meeting)
+                    record_migration(meeting, False, time.monotonic() - started)
 
         # Get recordings in storage
         stored_recordings = get_stored_recordings()
 
-        meetings = are_meetings_in_storage(meetings, stored_recordings)
+        meetings = state["meetings"] = are_meetings_in_storage(
+            state["meetings"], stored_recordings)
 
         failed_migrations = []
         for failed_migration_ID in failed_migration_IDs:
@@ -575,20 +3122,23 @@ def select_recordings():
                 if migrated_meeting_id == meeting["id"]:
                     migrated_meetings.append(meeting)
 
-        if (MIGRATE_RECORDINGS == "True"):
-            # Delete recordings from the Webex cloud
-            for meeting in migrated_meetings:
-                if delete_webex_recordings(meeting["id"], get_host_email(selected_person_id)[0]).ok:
-                    app.logger.info(
-                        f"Successfully deleted meeting with meeting id {meeting['id']}")
+        failed_deletions = []
+        if (MIGRATE_RECORDINGS == "True") and migrated_meetings:
+            # Delete recordings from the Webex cloud. Only recordings whose transfer was verified are in
+            # migrated_meetings, run_transfer() raises for the others
+            host_email = get_host_email(selected_person_id)[0]
+            _, failed_deletions = delete_migrated_recordings(
+                [dict(meeting, host_email=host_email) for meeting in migrated_meetings])
 
         if (AWS_ACCESS_KEY_ID != ""):
             s3_bucket_link = f"https://s3.console.aws.amazon.com/s3/buckets/{BUCKET_NAME}?region={REGION_NAME}&tab=objects"
         else:
             s3_bucket_link = f"file://{DOWNLOAD_FOLDER}"
 
-        return render_template('columnpage.html', sites=sites, selected_site=selected_site, meetings=meetings, migrated_meetings=migrated_meetings,
-                               failed_migrations=failed_migrations, s3_bucket_link=s3_bucket_link, people=people, selected_person_id=selected_person_id,
+        return render_template('columnpage.html', sites=state["sites"], selected_site=state["selected_site"], meetings_count=len(meetings), migrated_meetings=migrated_meetings,
+                               failed_migrations=failed_migrations, failed_deletions=failed_deletions, s3_bucket_link=s3_bucket_link,
+                               selected_person=dict(get_person_details(
+                                   selected_person_id), id=selected_person_id) if selected_person_id else None,
                                Action="Migrate" if (
                                    MIGRATE_RECORDINGS == "True") else "Copy",
                                Destination="AWS" if (AWS_ACCESS_KEY_ID != "") else "Local")
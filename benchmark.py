@@ -0,0 +1,826 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2022 Cisco and/or its affiliates.
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+               https://developer.cisco.com/docs/licenses
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+"""
+
+# Benchmark of the single-user and bulk migration flows of app.py against local stand-ins of the Webex API and
+# of S3, so performance changes can be measured without a Webex organization or an AWS account.
+#
+#     $ python benchmark.py --users 10 1000 10000
+#
+# Every scale and recording size runs in its own process, so the peak RSS reported is the one of that run only. The stand-ins run in
+# another process and count the requests they receive. The sessions flow runs against an HTTPS stand-in of the Webex
+# API, with a self-signed certificate made with the openssl command.
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import re
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SITE = "benchmark.webex.com"
+FROM_DATE = "2022-01-01"
+TO_DATE = "2022-01-31"
+BUCKET = "benchmark-recordings"
+
+
+########################
+### Webex stand-in   ###
+########################
+
+# Keep-alive HTTP/1.1 handler. Responses are sent without waiting for the ACK of the previous segment, like a real
+# server, so connections reused by the app are not slowed down by delayed ACKs
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    # Base URL of the server, to build the links sent back to the app
+    def base_url(self):
+        return f"{getattr(self.server, 'scheme', 'http')}://{self.headers['Host']}"
+
+
+# Stand-in of the Webex API endpoints used by the app: OAuth token, people, recordings listing with Link paging,
+# recording details with temporaryDirectDownloadLinks, deletion, and the download of the recordings themselves. API
+# requests wait for latency seconds, and throttle_rate of them are answered with 429. Access tokens expire after
+# token_lifetime seconds, if set, and API requests sent with an expired token are answered with 401. Requests for
+# the recordings of a user sent with the token of an admin of the admins flow who works on another user are
+# counted as cross_talk. Connections to the HTTPS stand-in are counted as tls_handshakes
+
+
+def make_webex_handler(options, stats):
+    period_start = datetime.strptime(FROM_DATE, "%Y-%m-%d")
+    period_seconds = (datetime.strptime(TO_DATE, "%Y-%m-%d") -
+                      period_start).total_seconds() + 24 * 60 * 60 - 1
+
+    def recordings_of(user):
+        # The same recordings for a user on every request, latest first like the Webex API
+        generator = random.Random(user)
+        recordings = []
+        for index in range(options["recordings_per_user"]):
+            recorded = period_start + \
+                timedelta(seconds=generator.randrange(int(period_seconds)))
+            recordings.append({
+                "id": f"u{user}r{index}", "topic": f"Meeting {index} of user {user}",
+                "timeRecorded": recorded.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "hostEmail": f"user{user}@benchmark.example", "serviceType": "MeetingCenter",
+                "sizeBytes": options["recording_size"], "format": "MP4"})
+        return sorted(recordings, key=lambda recording: recording["timeRecorded"], reverse=True)
+
+    def parse_time(value):
+        value = value if 'T' in value else value + "T00:00:00"
+        return datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S")
+
+    class WebexHandler(StandInHandler):
+        def log_message(self, *args):
+            pass
+
+        def setup(self):
+            super().setup()
+            if getattr(self.server, "scheme", "http") == "https":
+                self.count("tls_handshakes")
+
+        def send_json(self, body, status=200, headers=None):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def count(self, endpoint):
+            with stats["lock"]:
+                stats["requests"][endpoint] = stats["requests"].get(
+                    endpoint, 0) + 1
+
+        # Simulated latency, throttling (unless throttle is False) and token expiry of the API. Returns whether the
+        # request was refused
+        def api_call(self, endpoint, throttle=True):
+            self.count(endpoint)
+            time.sleep(options["latency"])
+            match = re.match(r"Bearer token-.*-expires(\d+)$",
+                             self.headers.get("Authorization", ""))
+            if match and int(match[1]) < time.time():
+                self.count("401")
+                self.send_json({"message": "The access token expired"}, 401)
+                return True
+            if throttle and options["throttle_rate"] and random.random() < options["throttle_rate"]:
+                self.count("429")
+                self.send_json({"message": "Too many requests"}, 429, {
+                               "Retry-After": str(options["retry_after"])})
+                return True
+            return False
+
+        # The admin of token "token-admin<index>" only works on the recordings of user index % users
+        def check_admin(self, user):
+            match = re.match(r"Bearer token-admin(\d+)-",
+                             self.headers.get("Authorization", ""))
+            if match and int(match[1]) % options["users"] != user:
+                self.count("cross_talk")
+
+        def next_link(self, path, query, offset, limit, total):
+            if offset + limit >= total:
+                return {}
+            query = dict(query, cursor=str(offset + limit))
+            return {"Link": f'<{self.base_url()}{path}?{urllib.parse.urlencode(query)}>; rel="next"'}
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            offset = int(query.get("cursor", 0))
+            limit = int(query.get("max", 100))
+            if url.path == "/_stats":
+                with stats["lock"]:
+                    return self.send_json(stats["requests"])
+            if url.path == "/v1/people":
+                if self.api_call("people"):
+                    return
+                users = range(offset, min(offset + limit, options["users"]))
+                return self.send_json({"items": [{"id": f"person{user}", "emails": [f"user{user}@benchmark.example"],
+                                                  "displayName": f"User {user}", "type": "person"} for user in users]},
+                                      headers=self.next_link(url.path, query, offset, limit, options["users"]))
+            if url.path == "/v1/people/me":
+                if self.api_call("people/me"):
+                    return
+                match = re.match(r"Bearer token-(.*)-expires",
+                                 self.headers.get("Authorization", ""))
+                return self.send_json({"id": f"admin-{match[1] if match else 'benchmark'}"})
+            match = re.match(r"/v1/people/person(\d+)$", url.path)
+            if match:
+                if self.api_call("people/{personId}"):
+                    return
+                user = match[1]
+                return self.send_json({"id": f"person{user}", "emails": [f"user{user}@benchmark.example"],
+                                       "displayName": f"User {user}"})
+            if url.path == "/v1/meetingPreferences/sites":
+                if self.api_call("meetingPreferences/sites"):
+                    return
+                return self.send_json({"sites": [{"siteUrl": SITE, "default": True}]})
+            if url.path == "/v1/recordings":
+                if self.api_call("recordings"):
+                    return
+                user = int(query["hostEmail"].split("@")[0][len("user"):])
+                self.check_admin(user)
+                start, end = parse_time(query["from"]), parse_time(query["to"])
+                recordings = [recording for recording in recordings_of(user)
+                              if start <= parse_time(recording["timeRecorded"]) <= end]
+                return self.send_json({"items": recordings[offset:offset + limit]},
+                                      headers=self.next_link(url.path, query, offset, limit, len(recordings)))
+            match = re.match(r"/v1/recordings/u(\d+)r(\d+)$", url.path)
+            if match:
+                if self.api_call("recordings/{recordingId}"):
+                    return
+                self.check_admin(int(match[1]))
+                recording = recordings_of(int(match[1]))[0]
+                recording = dict(recording, id=f"u{match[1]}r{match[2]}", temporaryDirectDownloadLinks={
+                    "recordingDownloadLink": f"{self.base_url()}/download/u{match[1]}r{match[2]}"})
+                return self.send_json(recording)
+            if url.path.startswith("/download/"):
+                self.count("download")
+                return self.send_recording()
+            self.send_json({"message": "Not found"}, 404)
+
+        def send_recording(self):
+            size = options["recording_size"]
+            start = 0
+            if self.headers.get("Range"):
+                start = int(self.headers["Range"].split("=")[1].split("-")[0])
+            self.send_response(206 if start else 200)
+            self.send_header("Content-Type", "video/mp4")
+            self.send_header("Content-Length", str(size - start))
+            self.end_headers()
+            chunk = b"\0" * 65536
+            remaining = size - start
+            while remaining:
+                sent = min(remaining, len(chunk))
+                self.wfile.write(chunk[:sent])
+                remaining -= sent
+
+        def do_POST(self):
+            if urllib.parse.urlparse(self.path).path != "/v1/access_token":
+                return self.send_json({"message": "Not found"}, 404)
+            body = urllib.parse.parse_qs(self.rfile.read(
+                int(self.headers["Content-Length"])).decode())
+            # Token exchanges are not throttled, so --throttle-rate only measures the recording endpoints
+            if self.api_call("access_token", throttle=False):
+                return
+            # The refresh token is the name of the admin, which is also the authorization code
+            name = body["code"][0] if body["grant_type"][0] == "authorization_code" else body["refresh_token"][0]
+            lifetime = options["token_lifetime"] or 14 * 24 * 60 * 60
+            self.send_json({"access_token": f"token-{name}-expires{int(time.time() + lifetime)}",
+                            "expires_in": lifetime, "refresh_token": name,
+                            "refresh_token_expires_in": 90 * 24 * 60 * 60})
+
+        def do_DELETE(self):
+            if self.api_call("DELETE recordings/{recordingId}"):
+                return
+            self.send_response(204)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    return WebexHandler
+
+
+########################
+### S3 stand-in      ###
+########################
+
+# Minimal S3 compatible API, enough for the calls of the app: objects, multipart uploads and listings. Only the
+# sizes of the recordings are kept, their bytes are discarded. The '.json' sidecars are kept whole, to be read back
+
+
+def make_s3_handler(stats):
+    objects = {}
+    sidecars = {}
+    uploads = {}
+    upload_ids = itertools.count(1)
+    lock = threading.Lock()
+
+    class S3Handler(StandInHandler):
+        def log_message(self, *args):
+            pass
+
+        def send_xml(self, body, status=200, headers=None):
+            data = ('<?xml version="1.0" encoding="UTF-8"?>' + body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/xml")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_empty(self, status=200, headers=None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            if "Content-Length" not in (headers or {}):
+                self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def parse(self, operation):
+            with stats["lock"]:
+                stats["requests"][operation] = stats["requests"].get(
+                    operation, 0) + 1
+            url = urllib.parse.urlparse(self.path)
+            parts = url.path.lstrip("/").split("/", 1)
+            key = urllib.parse.unquote(parts[1]) if len(parts) > 1 else ""
+            return key, dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+
+        # Read the body and return its size, without the aws-chunked encoding of newer SDKs
+        def read_body(self):
+            length = int(self.headers.get("Content-Length", 0))
+            remaining = length
+            while remaining:
+                remaining -= len(self.rfile.read(min(remaining, 1 << 20)))
+            return int(self.headers.get("x-amz-decoded-content-length", length))
+
+        # Read a small body whole, decoding the aws-chunked encoding of newer SDKs
+        def read_data(self):
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if "x-amz-decoded-content-length" not in self.headers:
+                return data
+            decoded = b""
+            while True:
+                header, data = data.split(b"\r\n", 1)
+                size = int(header.split(b";")[0], 16)
+                if not size:
+                    return decoded
+                decoded, data = decoded + data[:size], data[size + 2:]
+
+        def not_found(self):
+            self.send_xml("<Error><Code>NoSuchKey</Code></Error>", 404)
+
+        def do_HEAD(self):
+            key, _ = self.parse("HeadObject")
+            with lock:
+                size = objects.get(key)
+            if size is None:
+                return self.send_empty(404)
+            self.send_empty(200, {"Content-Length": str(size), "ETag": '"0"'})
+
+        def do_PUT(self):
+            key, query = self.parse(
+                "UploadPart" if "uploadId" in query_of(self.path) else "PutObject")
+            if key.endswith(".json"):
+                data = self.read_data()
+                size = len(data)
+                with lock:
+                    sidecars[key] = data
+            else:
+                size = self.read_body()
+            with lock:
+                if "uploadId" in query:
+                    uploads[query["uploadId"]]["parts"][int(
+                        query["partNumber"])] = size
+                else:
+                    objects[key] = size
+            self.send_empty(200, {"ETag": f'"{size}"'})
+
+        def do_POST(self):
+            key, query = self.parse("CreateMultipartUpload" if "uploads" in query_of(
+                self.path) else "CompleteMultipartUpload")
+            self.read_body()
+            with lock:
+                if "uploads" in query:
+                    upload_id = f"upload{next(upload_ids)}"
+                    uploads[upload_id] = {"key": key, "parts": {}}
+                    return self.send_xml(f"<InitiateMultipartUploadResult><Bucket>{BUCKET}</Bucket><Key>{key}</Key>"
+                                         f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>")
+                upload = uploads.pop(query["uploadId"], None)
+                if upload is None:
+                    return self.send_xml("<Error><Code>NoSuchUpload</Code></Error>", 404)
+                objects[key] = sum(upload["parts"].values())
+            self.send_xml(f"<CompleteMultipartUploadResult><Bucket>{BUCKET}</Bucket><Key>{key}</Key>"
+                          f"<ETag>\"0\"</ETag></CompleteMultipartUploadResult>")
+
+        def do_DELETE(self):
+            key, query = self.parse("AbortMultipartUpload" if "uploadId" in query_of(
+                self.path) else "DeleteObject")
+            with lock:
+                if "uploadId" in query:
+                    uploads.pop(query["uploadId"], None)
+                else:
+                    objects.pop(key, None)
+                    sidecars.pop(key, None)
+            self.send_empty(204)
+
+        def do_GET(self):
+            if self.path == "/_stats":
+                with stats["lock"]:
+                    data = json.dumps(stats["requests"]).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                return self.wfile.write(data)
+            if "uploadId" not in query_of(self.path) and urllib.parse.urlparse(self.path).path.strip("/").count("/"):
+                key, _ = self.parse("GetObject")
+                with lock:
+                    data = sidecars.get(key)
+                if data is None:
+                    return self.not_found()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                return self.wfile.write(data)
+            key, query = self.parse(
+                "ListParts" if "uploadId" in query_of(self.path) else "ListObjectsV2")
+            with lock:
+                if "uploadId" in query:
+                    upload = uploads.get(query["uploadId"])
+                    if upload is None:
+                        return self.send_xml("<Error><Code>NoSuchUpload</Code></Error>", 404)
+                    parts = "".join(f"<Part><PartNumber>{number}</PartNumber><ETag>\"{size}\"</ETag><Size>{size}</Size></Part>"
+                                    for number, size in sorted(upload["parts"].items()))
+                    return self.send_xml(f"<ListPartsResult><Bucket>{BUCKET}</Bucket><Key>{key}</Key>"
+                                         f"<UploadId>{query['uploadId']}</UploadId><IsTruncated>false</IsTruncated>"
+                                         f"{parts}</ListPartsResult>")
+                start_after = query.get(
+                    "continuation-token") or query.get("start-after") or ""
+                keys = sorted(
+                    name for name in objects if name > start_after)
+                page = keys[:int(query.get("max-keys", 1000))]
+                contents = "".join(f"<Contents><Key>{name}</Key><Size>{objects[name]}</Size></Contents>"
+                                   for name in page)
+            truncated = len(page) < len(keys)
+            token = f"<NextContinuationToken>{page[-1]}</NextContinuationToken>" if truncated else ""
+            self.send_xml(f"<ListBucketResult><Name>{BUCKET}</Name><KeyCount>{len(page)}</KeyCount>"
+                          f"<IsTruncated>{'true' if truncated else 'false'}</IsTruncated>{token}{contents}"
+                          f"</ListBucketResult>")
+
+    return S3Handler
+
+
+def query_of(path):
+    return dict(urllib.parse.parse_qsl(urllib.parse.urlparse(path).query, keep_blank_values=True))
+
+# Run the stand-ins of Webex and S3 until the parent process stops them, and report their ports. When options has a
+# certificate, the Webex stand-in is also served over HTTPS with it, on a third port sharing its request counts
+
+
+def serve_stand_ins(options, ports):
+    webex_handler = make_webex_handler(
+        options, {"lock": threading.Lock(), "requests": {}})
+    servers = []
+    for handler in (webex_handler, make_s3_handler({"lock": threading.Lock(), "requests": {}})) + \
+            ((webex_handler,) if options.get("certificate") else ()):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        server.daemon_threads = True
+        server.request_queue_size = 128
+        servers.append(server)
+    if options.get("certificate"):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(options["certificate"], options["key"])
+        servers[2].socket = context.wrap_socket(
+            servers[2].socket, server_side=True)
+        servers[2].scheme = "https"
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    ports.put([server.server_port for server in servers])
+    threading.Event().wait()
+
+# Make a self-signed certificate for 127.0.0.1 in folder, returns the paths of the certificate and of its key
+
+
+def make_certificate(folder):
+    certificate, key = os.path.join(
+        folder, "stand-in.pem"), os.path.join(folder, "stand-in.key")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=127.0.0.1",
+                    "-addext", "subjectAltName=IP:127.0.0.1", "-keyout", key, "-out", certificate],
+                   check=True, capture_output=True)
+    return certificate, key
+
+
+def get_stats(port):
+    import requests
+    return requests.get(f"http://127.0.0.1:{port}/_stats").json()
+
+
+########################
+### Benchmark runs   ###
+########################
+
+# Environment of the app for a run, pointed at the stand-ins
+
+
+def app_environment(args, webex_port, s3_port, state_db):
+    environment = dict(os.environ,
+                       WEBEX_BASE_URL=f"http://127.0.0.1:{webex_port}/v1",
+                       WEBEX_API_RATE_LIMIT=str(args.rate_limit),
+                       WEBEX_BACKOFF_BASE="0.1",
+                       STATE_DB=state_db,
+                       MIGRATE_RECORDINGS="True" if args.delete else "False",
+                       STRUCTURED_LOGS="False",
+                       SESSION_STORE=args.session_store,
+                       WEBEX_TOKEN_REFRESH_MARGIN=str(args.token_lifetime // 4),
+                       BULK_NAME_FILTER="")
+    if args.storage == "s3":
+        environment.update(AWS_ACCESS_KEY_ID="benchmark", AWS_SECRET_ACCESS_KEY="benchmark",
+                           REGION_NAME="us-east-1", BUCKET_NAME=BUCKET,
+                           S3_ENDPOINT_URL=f"http://127.0.0.1:{s3_port}")
+    else:
+        environment.update(AWS_ACCESS_KEY_ID="",
+                           DOWNLOAD_FOLDER=os.path.join(os.path.dirname(state_db), "recordings", ""))
+        os.makedirs(environment["DOWNLOAD_FOLDER"], exist_ok=True)
+    return environment
+
+# Bulk flow: run a migration job of all the users, the way the background job runner does
+
+
+def run_bulk(app, args):
+    app.current_webex_token.set(app.WebexToken(
+        app.get_webex_access_token("benchmark")))
+    job_id = app.migration_journal.create_job(SITE, FROM_DATE, TO_DATE)
+    app.claim_job(job_id)
+    progress = app.JobProgress(job_id)
+    migrated, failed, failed_listings = app.run_bulk_job(job_id, progress)
+    return {"migrated": len(migrated), "failed": len(failed), "failed_listings": len(failed_listings),
+            "bytes": progress.bytes_transferred}
+
+# Single-user flow: for every user, list the recordings of the period and migrate them through the web pages
+
+
+def run_single(app, args):
+    # A session already logged in
+    app.session_store.set("benchmark", {"token": app.get_webex_access_token("benchmark"), "sites": [{"siteUrl": SITE}], "selected_site": "",
+                                        "meetings": [], "selected_person_id": ""})
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session["bulk"] = False
+        session["sid"] = "benchmark"
+    migrated = failed = 0
+    for user in range(min(args.single_users or args.run_users, args.run_users)):
+        client.post("/select_period", data={"fromdate": FROM_DATE, "todate": TO_DATE, "site": SITE,
+                                            "person": f"person{user}"})
+        meeting_ids = [meeting["id"]
+                       for meeting in app.session_store.get("benchmark")["meetings"]]
+        client.post("/select_recordings", data={"meeting_id": meeting_ids})
+        failed += sum(1 for meeting in app.session_store.get("benchmark")["meetings"]
+                      if meeting["id"] in meeting_ids and not meeting.get("inStorage"))
+        migrated += len(meeting_ids)
+    return {"migrated": migrated - failed, "failed": failed, "bytes": (migrated - failed) * args.run_recording_size}
+
+# Admins flow: load test of --admins admins using the app at the same time through a threaded server, each with
+# their own login and working on their own user, for --admin-rounds rounds of listing and migrating the recordings
+# of the user. Every page and page of recordings an admin gets must only show the recordings of their user, any
+# other recording is counted as an isolation error. The latency of a listing includes its first page of recordings
+
+
+def run_admins(app, args):
+    import requests
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+    lock = threading.Lock()
+    totals = {"migrated": 0, "isolation_errors": 0, "latencies": []}
+
+    def check_page(page, user):
+        users = {int(found) for found in re.findall(
+            r"Meeting \d+ of user (\d+)", page.text)}
+        return len(users - {user})
+
+    def admin(index):
+        user = index % args.run_users
+        client = requests.Session()
+        client.get(f"{url}/").raise_for_status()
+        client.get(f"{url}/webexoauth",
+                   params={"code": f"admin{index}"}).raise_for_status()
+        # The first page of the person picker, loaded by the page
+        client.get(f"{url}/people").raise_for_status()
+        migrated = errors = 0
+        latencies = []
+        for _ in range(args.admin_rounds):
+            started = time.perf_counter()
+            page = client.post(f"{url}/select_period", data={"fromdate": FROM_DATE, "todate": TO_DATE, "site": SITE,
+                                                              "person": f"person{user}"})
+            page.raise_for_status()
+            recordings = client.get(
+                f"{url}/recordings", params={"per_page": 500}).json()["items"]
+            latencies.append(time.perf_counter() - started)
+            errors += sum(1 for recording in recordings
+                          if not recording["id"].startswith(f"u{user}r"))
+            meeting_ids = [recording["id"]
+                           for recording in recordings if not recording["inStorage"]]
+            started = time.perf_counter()
+            page = client.post(f"{url}/select_recordings",
+                               data={"meeting_id": meeting_ids})
+            latencies.append(time.perf_counter() - started)
+            page.raise_for_status()
+            errors += check_page(page, user)
+            migrated += page.text.count("toast__icon text-success")
+        with lock:
+            totals["migrated"] += migrated
+            totals["isolation_errors"] += errors
+            totals["latencies"] += latencies
+
+    threads = [threading.Thread(target=admin, args=(index,))
+               for index in range(args.admins)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+    latencies = sorted(totals["latencies"])
+    return {"admins": args.admins, "migrated": totals["migrated"], "failed": 0,
+            "bytes": totals["migrated"] * args.run_recording_size, "isolation_errors": totals["isolation_errors"],
+            "page_p50_ms": 1000 * latencies[len(latencies) // 2],
+            "page_p99_ms": 1000 * latencies[int(len(latencies) * 0.99)]}
+
+# Compare the latency of API requests and recording downloads sent through the pooled session of the app with a new
+# connection per request, against the HTTPS stand-in of Webex, and count the TLS handshakes of every case
+
+
+def run_sessions(app, args):
+    import requests
+    verify = args.run_certificate
+    app.http_session.verify = verify
+    root = app.WEBEX_BASE_URL[:-len("/v1")]
+    url = f"{app.WEBEX_BASE_URL}/meetingPreferences/sites"
+    link = f"{root}/download/u0r0"
+
+    def handshakes():
+        # Sent on a connection of its own, which is one handshake more
+        return requests.get(f"{root}/_stats", headers={"Connection": "close"}, verify=verify).json().get("tls_handshakes", 0)
+
+    def download_new_connection():
+        with requests.get(link, headers={"Connection": "close"}, stream=True, verify=verify) as response:
+            response.raise_for_status()
+            for _ in response.iter_content(app.TRANSFER_BUFFER_SIZE):
+                pass
+
+    def download_pooled_session():
+        with app.ResumableDownload(link) as download:
+            for _ in app.read_parts(download, app.TRANSFER_BUFFER_SIZE):
+                pass
+
+    results = {}
+    for name, send in (("new_connection", lambda: requests.get(url, headers={"Connection": "close"}, verify=verify).raise_for_status()),
+                       ("pooled_session", lambda: app.http_session.get(
+                           url).raise_for_status()),
+                       ("download_new_connection", download_new_connection),
+                       ("download_pooled_session", download_pooled_session)):
+        before = handshakes()
+        latencies = []
+        for _ in range(args.session_requests):
+            started = time.perf_counter()
+            send()
+            latencies.append(time.perf_counter() - started)
+        latencies.sort()
+        results[name] = {"mean_ms": 1000 * sum(latencies) / len(latencies),
+                         "p50_ms": 1000 * latencies[len(latencies) // 2],
+                         "p99_ms": 1000 * latencies[int(len(latencies) * 0.99)],
+                         "tls_handshakes": handshakes() - before - 1}
+    return results
+
+# Run one flow at one scale, in the current process (started by main() with the environment of the app set)
+
+
+def run_flow(args):
+    import resource
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    started = time.perf_counter()
+    result = {"bulk": run_bulk, "single": run_single, "sessions": run_sessions,
+              "admins": run_admins}[args.run](app, args)
+    result["wall_seconds"] = time.perf_counter() - started
+    # The transfer worker processes and the limiter manager must have exited for RUSAGE_CHILDREN to count them
+    if app.transfer_pool is not None:
+        app.transfer_pool.shutdown()
+    if app.limiter_manager is not None:
+        app.limiter_manager.shutdown()
+    result["peak_rss_mb"] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss / 1024
+    # Largest of the worker processes, 0 when the transfers run in threads
+    result["worker_peak_rss_mb"] = resource.getrusage(
+        resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    result["webex_api"] = {endpoint: metrics["requests"]
+                           for endpoint, metrics in app.webex_api_metrics.summary().items()}
+    print(json.dumps(result))
+
+# Start the stand-ins, then run every flow and scale in a process of its own and print a report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the migration flows against local stand-ins of the Webex API and S3")
+    parser.add_argument("--users", type=int, nargs="+", default=[10, 1000, 10000],
+                        help="Numbers of users to benchmark (default: 10 1000 10000)")
+    parser.add_argument("--flows", nargs="+", default=["bulk", "single"], choices=["bulk", "single", "sessions", "admins"],
+                        help="Flows to benchmark (default: bulk single)")
+    parser.add_argument("--recordings-per-user", type=int, default=2)
+    parser.add_argument("--recording-size", type=int, nargs="+", default=[256 * 1024],
+                        help="Sizes of the recordings in bytes, every size is benchmarked (default: 262144)")
+    parser.add_argument("--rss-tolerance", type=float, default=32,
+                        help="MB the peak RSS of a flow may grow by between recording sizes larger than the transfer buffer")
+    parser.add_argument("--single-users", type=int, default=10,
+                        help="Maximum number of users migrated one after the other by the single-user flow")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="Seconds the Webex stand-in waits before answering an API request")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="Share of the Webex API requests, other than the token exchanges, answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1,
+                        help="Retry-After of the throttled requests, in seconds")
+    parser.add_argument("--token-lifetime", type=int, default=0,
+                        help="Seconds before the access tokens of the Webex stand-in expire (default: 14 days)")
+    parser.add_argument("--rate-limit", type=float, default=0,
+                        help="WEBEX_API_RATE_LIMIT of the app, 0 for no limit")
+    parser.add_argument("--storage", choices=["s3", "local"], default="s3")
+    parser.add_argument("--delete", action="store_true",
+                        help="Delete the recordings from the Webex stand-in after migrating them")
+    parser.add_argument("--session-requests", type=int, default=200,
+                        help="Requests sent for each case of the sessions flow")
+    parser.add_argument("--admins", type=int, default=10,
+                        help="Admins using the app at the same time in the admins flow")
+    parser.add_argument("--admin-rounds", type=int, default=3,
+                        help="Rounds of listing and migrating recordings of every admin of the admins flow")
+    parser.add_argument("--session-store", choices=["memory", "sqlite"], default="memory",
+                        help="SESSION_STORE of the app")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    parser.add_argument("--run-users", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--run-recording-size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--run-certificate", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        return run_flow(args)
+
+    report = []
+    certificates = tempfile.TemporaryDirectory()
+    certificate, key = make_certificate(
+        certificates.name) if "sessions" in args.flows else (None, None)
+    for recording_size, users in itertools.product(args.recording_size, args.users):
+        options = {"users": users, "recordings_per_user": args.recordings_per_user,
+                   "recording_size": recording_size, "latency": args.latency,
+                   "throttle_rate": args.throttle_rate, "retry_after": args.retry_after,
+                   "token_lifetime": args.token_lifetime, "certificate": certificate, "key": key}
+        ports = multiprocessing.Queue()
+        stand_ins = multiprocessing.Process(
+            target=serve_stand_ins, args=(options, ports), daemon=True)
+        stand_ins.start()
+        webex_port, s3_port, *https_port = ports.get()
+        try:
+            for flow in args.flows:
+                with tempfile.TemporaryDirectory() as folder:
+                    environment = app_environment(
+                        args, webex_port, s3_port, os.path.join(folder, "state.db"))
+                    webex_before, s3_before = get_stats(
+                        webex_port), get_stats(s3_port)
+                    command = [sys.executable, os.path.abspath(__file__), "--run", flow, "--run-users", str(users),
+                               "--run-recording-size", str(recording_size)] + [argument for argument in sys.argv[1:]]
+                    if flow == "sessions":
+                        environment["WEBEX_BASE_URL"] = f"https://127.0.0.1:{https_port[0]}/v1"
+                        command += ["--run-certificate", certificate]
+                        # They would take precedence over the certificate set as the verify of the session of the app
+                        for name in ("REQUESTS_CA_BUNDLE", "CURL_CA_BUNDLE"):
+                            environment.pop(name, None)
+                    output = subprocess.run(command, env=environment, cwd=folder, capture_output=True, text=True)
+                    if output.returncode != 0:
+                        print(output.stderr, file=sys.stderr)
+                        raise SystemExit(f"The {flow} flow failed with {users} users")
+                    result = json.loads(output.stdout.strip().splitlines()[-1])
+                    result.update(flow=flow, users=users, recording_size=recording_size,
+                                  webex_requests=difference(
+                                      get_stats(webex_port), webex_before),
+                                  s3_requests=difference(get_stats(s3_port), s3_before))
+                    report.append(result)
+                    print_result(result)
+                    check_result(result)
+        finally:
+            stand_ins.terminate()
+    certificates.cleanup()
+    print(json.dumps(report, indent=2))
+    check_memory(report, args.rss_tolerance)
+
+
+# Fail the benchmark if a run broke a guarantee of the app: every recording migrated by the bulk and single flows
+# must have been downloaded exactly once, and admins must only see, and send Webex requests for, their own user
+
+
+def check_result(result):
+    if result["flow"] in ("bulk", "single") and result["webex_requests"].get("download", 0) != result["migrated"]:
+        raise SystemExit(f"The {result['flow']} flow with {result['users']} users downloaded "
+                         f"{result['webex_requests'].get('download', 0)} recordings to migrate {result['migrated']}")
+    if result["flow"] == "admins" and (result["isolation_errors"] or result["webex_requests"].get("cross_talk", 0)):
+        raise SystemExit(f"The admins flow with {result['users']} users had {result['isolation_errors']} isolation "
+                         f"errors and {result['webex_requests'].get('cross_talk', 0)} Webex requests with the token "
+                         f"of another admin")
+
+
+# Fail the benchmark if the memory used by the transfers grows with the size of the recordings: for every flow and
+# scale, the runs with recordings larger than the transfer buffer must all have the same peak RSS, within tolerance MB,
+# both for the app process and for its largest transfer worker process
+
+
+def check_memory(report, tolerance):
+    buffer_size = int(os.getenv("TRANSFER_BUFFER_SIZE") or 8 * 1024 * 1024)
+    runs = {}
+    for result in report:
+        if result["flow"] in ("bulk", "single") and result["recording_size"] >= buffer_size:
+            runs.setdefault((result["flow"], result["users"]), []).append(result)
+    for (flow, users), results in runs.items():
+        smallest = min(results, key=lambda result: result["recording_size"])
+        largest = max(results, key=lambda result: result["recording_size"])
+        for key, name in (("peak_rss_mb", "peak RSS"), ("worker_peak_rss_mb", "worker peak RSS")):
+            if largest[key] - smallest[key] > tolerance:
+                raise SystemExit(f"The {name} of the {flow} flow with {users} users grew from {smallest[key]:.0f} MB "
+                                 f"to {largest[key]:.0f} MB with recordings of {smallest['recording_size']} "
+                                 f"and {largest['recording_size']} bytes")
+            if len(results) > 1 and (key == "peak_rss_mb" or largest[key]):
+                print(f"{flow} users={users}: {name} {smallest[key]:.0f} MB with recordings of "
+                      f"{smallest['recording_size']} bytes, {largest[key]:.0f} MB with {largest['recording_size']} bytes")
+
+
+def difference(after, before):
+    return {name: count - before.get(name, 0) for name, count in after.items() if count != before.get(name, 0)}
+
+
+def print_result(result):
+    if result["flow"] == "sessions":
+        print(f"sessions users={result['users']}: " + ", ".join(
+            f"{name} mean {latency['mean_ms']:.2f} ms p50 {latency['p50_ms']:.2f} ms p99 {latency['p99_ms']:.2f} ms "
+            f"({latency['tls_handshakes']} TLS handshakes)"
+            for name, latency in result.items() if isinstance(latency, dict) and "mean_ms" in latency))
+        return
+    wall = result["wall_seconds"]
+    print(f"{result['flow']} users={result['users']} size={result['recording_size']}: {wall:.1f} s, peak RSS {result['peak_rss_mb']:.0f} MB, "
+          + (f"worker peak RSS {result['worker_peak_rss_mb']:.0f} MB, " if result['worker_peak_rss_mb'] else "") +
+          f"{sum(result['webex_requests'].values())} Webex requests, {sum(result['s3_requests'].values())} S3 requests, "
+          f"{result['migrated']} recordings migrated ({result['failed']} failed), "
+          f"{result['migrated'] / wall:.1f} recordings/s, {result['bytes'] / wall / 1024 / 1024:.1f} MB/s")
+    if result["flow"] == "admins":
+        print(f"admins={result['admins']}: pages p50 {result['page_p50_ms']:.0f} ms p99 {result['page_p99_ms']:.0f} ms, "
+              f"{result['isolation_errors']} isolation errors, {result['webex_requests'].get('cross_talk', 0)} "
+              f"Webex requests with the token of another admin")
+
+
+if __name__ == "__main__":
+    main()